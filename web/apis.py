@@ -1,45 +1,209 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from model import User, Food, Record
-from webframe import get, post, APIError, APIPermissionError, APIResourceError, APIValueError
+from model import User, Food, Record, DailySummary
+from webframe import get, post, conditional, APIError, APIPermissionError, APIResourceError, APIValueError
+from cache import CatalogCache, LRUCache
+import dao, summary, metrics
+from configs import configs
+from planner import MealPlanner
+from search import NameIndex
+from serializer import dumps
 from aiohttp import web
-import re, hashlib, json, logging
+import re, hashlib, logging
+
+
+# food表几乎不修改，直接缓存在内存中，Food的save/change/remove会使缓存失效
+foods_cache = CatalogCache(Food)
+
+# 把一批新记录累加到汇总表中，与记录在同一个事务中写入
+async def add_summaries(records):
+    foods = await foods_cache.get_many({r.food_id for r in records})
+    await summary.add_records(records, foods)
+
+# 用餐时间大量的记录同时写入，开启group_commit时合并成批量insert，汇总也按批累加
+records_buffer = dao.WriteBuffer(Record, configs.db.group_commit.delay, configs.db.group_commit.max_rows,
+                                 on_write=add_summaries)
 
+# 记录和汇总在同一个事务中写入，汇总写入失败时记录也会回滚，客户端重试不会产生重复的记录
+async def save_record(record, foods):
+    if configs.db.group_commit.enabled:
+        await records_buffer.save(record)
+        return
+    async with dao.transaction():
+        await record.save()
+        await summary.add_records([record], foods)
 
 # 对于返回json的api，只需要规定return的是dict，在webframe的response_middleware中就会把结果转化成json格式
+# 只输出JSON的查询用as_dicts=True直接取得dict，序列化时不需要逐行回调Python
+# 列表类的api都采用keyset分页，after是上一次返回的next游标，size不能超过configs中的上限
+# GET的api用@conditional声明依赖的表，表没有修改时对带If-None-Match的请求返回304
 @get('/api/foods')
-async def getAllFoods():
-    foods = await Food.find()
-    return dict(foods=foods)
+@conditional(Food, cache_control='public, max-age=60')
+async def getAllFoods(*, after=None, size=None):
+    size = page_size(size)
+    try:
+        foods, cursor = await foods_cache.page(after, size, as_dicts=True)
+    except (ValueError, TypeError):
+        raise APIValueError('after', 'Invalid cursor.')
+    return dict(foods=foods, next=cursor)
 
-@post('/api/record')
-async def addRecord(request, *, food_id, amount, record_time):
-    check_admin(request)
-    food_id = food_id.strip()
-    amount = float(amount)
-    if not record_time:
-        record_time = time.time()
+# 检查一条记录的参数，返回还没有保存的Record
+def make_record(user, food_id, amount, record_time):
+    food_id = str(food_id).strip() if food_id is not None else ''
     if not food_id:
         raise APIValueError('food', 'food must not be empty')
+    try:
+        food_id = int(food_id)
+    except ValueError:
+        raise APIValueError('food', 'food must be an integer id')
+    try:
+        amount = float(amount)
+        record_time = float(record_time) if record_time else time.time()
+    except (TypeError, ValueError):
+        raise APIValueError('amount', 'amount and record_time must be numbers')
     if not amount or amount<0.00001:
         raise APIValueError('amount', 'amount must not be empty')
-    record = Record(food_id=food_id, user_id=request.__user__.user_id, amount=amount, record_time=record_time)
-    await record.save()
+    return Record(food_id=food_id, user_id=user.user_id, amount=amount, record_time=record_time)
+
+# 食物名称的索引，Food写入时增量更新
+foods_index = NameIndex(Food, 'food_name')
+
+@get('/api/foods/search')
+@conditional(Food, cache_control='public, max-age=60')
+async def searchFoods(*, q='', limit=None):
+    try:
+        limit = int(limit or 10)
+    except ValueError:
+        raise APIValueError('limit', 'limit must be an integer')
+    if limit < 1:
+        raise APIValueError('limit', 'limit must be positive')
+    limit = min(limit, configs.page.max_size)
+    await foods_index.refresh(foods_cache)
+    return dict(foods=foods_index.search(q, limit))
+
+@post('/api/record')
+async def addRecord(request, *, food_id, amount, record_time):
+    check_admin(request)
+    record = make_record(request.__user__, food_id, amount, record_time)
+    foods = await foods_cache.get_many([record.food_id])
+    if not foods:
+        raise APIResourceError('food', 'food not found')
+    await save_record(record, foods)
     return record
 
+# 一次提交多条记录（比如同步一整天的饮食），records是记录的list，
+# 合法的记录在一个事务中一次写入，results按顺序返回每一条的结果
+@post('/api/records/bulk')
+async def addRecords(request, *, records):
+    check_admin(request)
+    if not isinstance(records, list):
+        raise APIValueError('records', 'records must be a list')
+    if len(records) > configs.bulk.max_size:
+        raise APIValueError('records', 'at most %s records at a time' % configs.bulk.max_size)
+    results = []
+    valid = []
+    for item in records:
+        try:
+            if not isinstance(item, dict):
+                raise APIValueError('record', 'record must be an object')
+            record = make_record(request.__user__, item.get('food_id'), item.get('amount'), item.get('record_time'))
+        except APIError as e:
+            results.append(dict(error=e.error, data=e.data, message=e.message))
+            continue
+        valid.append(record)
+        results.append(dict(record=record))
+    foods = await foods_cache.get_many({r.food_id for r in valid})
+    for i, result in enumerate(results):
+        record = result.get('record')
+        if record is not None and record.food_id not in foods:
+            results[i] = dict(error='Value: Not Found', data='food', message='food not found')
+    valid = [r for r in valid if r.food_id in foods]
+    # 记录和汇总在同一个事务中写入，不会出现只写了一半的情况
+    async with dao.transaction():
+        await Record.save_many(valid)
+        await summary.add_records(valid, foods)
+    return dict(results=results)
+
+meal_planner = MealPlanner()
+
+# 根据营养目标推荐食物组合，size是每个组合最多包含的食物种数，count是返回的组合数
+@get('/api/plan')
+@conditional(Food, cache_control='public, max-age=60')
+async def plan(*, energy=None, protein=None, fat=None, carbohydrate=None, size=None, count=None):
+    targets = dict()
+    for name, value in zip(('energy', 'protein', 'fat', 'carbohydrate'), (energy, protein, fat, carbohydrate)):
+        if value:
+            try:
+                targets[name] = float(value)
+            except ValueError:
+                raise APIValueError(name, '%s must be a number' % name)
+    if not any(v > 0 for v in targets.values()):
+        raise APIValueError('targets', 'at least one positive target is required')
+    try:
+        size = min(int(size or 3), configs.plan.max_size)
+        count = min(int(count or 5), configs.plan.max_count)
+    except ValueError:
+        raise APIValueError('size', 'size and count must be integers')
+    if size < 1 or count < 1:
+        raise APIValueError('size', 'size and count must be positive')
+    await meal_planner.refresh(foods_cache)
+    plans = []
+    for error, items in meal_planner.plan(targets, size, count):
+        plans.append(dict(
+            error=error,
+            foods=[dict(food=meal_planner.foods[i], amount=amount) for i, amount in items],
+            totals=meal_planner.totals(items)))
+    return dict(plans=plans)
+
+# 按天返回营养摄入的汇总，只读daily_summary表，start和end是'YYYY-MM-DD'格式的日期（包含）
+# 汇总由summary.add_records直接写入，不经过Model，所以ETag同时依赖record表
+@get('/api/summary/daily')
+@conditional(Record, DailySummary, per_user=True)
+async def get_daily_summary(request, *, start=None, end=None):
+    check_admin(request)
+    where = ['user_id=?']
+    args = [request.__user__.user_id]
+    if start:
+        where.append('day>=?')
+        args.append(start)
+    if end:
+        where.append('day<=?')
+        args.append(end)
+    days = await DailySummary.find(' and '.join(where), args, orderBy='`day`', as_dicts=True)
+    return dict(days=days)
+
 @get('/api/records')
-async def get_records(request):
+@conditional(Record, per_user=True)
+async def get_records(request, *, after=None, size=None):
+    check_admin(request)
+    size = page_size(size)
+    try:
+        records, cursor = await Record.findPage('user_id=?', [request.__user__.user_id],
+                                                after=after, size=size, orderBy='record_time', desc=True,
+                                                as_dicts=True)
+    except ValueError:
+        raise APIValueError('after', 'Invalid cursor.')
+    return dict(records=records, next=cursor)
+
+# 导出全部记录，记录可能很多，所以用流式的方式一边查询一边输出
+@get('/api/records/export')
+async def export_records(request):
     check_admin(request)
-    records = await Record.find(where='user_id=?', args=[request.__user__.user_id])
+    records = Record.stream('user_id=?', [request.__user__.user_id], orderBy='`record_time`', as_dicts=True)
     return dict(records=records)
 
 @get('/api/users')
-async def getAllUsers():
-    users = await User.find()
+@conditional(User)
+async def getAllUsers(*, after=None, size=None):
+    size = page_size(size)
+    try:
+        users, cursor = await User.findPage(after=after, size=size, as_dicts=True)
+    except ValueError:
+        raise APIValueError('after', 'Invalid cursor.')
     for user in users:
-        user.password = '******'
-    return dict(users=users)
+        user['password'] = '******'
+    return dict(users=users, next=cursor)
 
 @post('/api/user')
 async def registerUser(*, username, password, email, phone):
@@ -55,13 +219,15 @@ async def registerUser(*, username, password, email, phone):
         raise APIError('password')
     if not email or not _RE_EMAIL.match(email):
         raise APIError('email')
-    users = await User.find('username=? or email=?', [username, email])
-    if len(users) > 0:
-        raise APIError('register:failed', '', 'Email or Username is already in use.')
-    # 虽然传过来的password已经是加密过的了，这里统一在做一次摘要算法加密
-    user = User(username=username, email=email,
-                password=hashlib.sha1(password.encode('utf-8')).hexdigest(), phone=phone)
-    await user.save()
+    # 检查和写入使用同一个连接，一次commit
+    async with dao.transaction():
+        users = await User.find('username=? or email=?', [username, email])
+        if len(users) > 0:
+            raise APIError('register:failed', '', 'Email or Username is already in use.')
+        # 虽然传过来的password已经是加密过的了，这里统一在做一次摘要算法加密
+        user = User(username=username, email=email,
+                    password=hashlib.sha1(password.encode('utf-8')).hexdigest(), phone=phone)
+        await user.save()
     # make session cookie:
     return make_session(user)
 
@@ -81,6 +247,11 @@ async def authenticate(*, useremail, password):
     # authenticate OK, make session cookie:
     return make_session(user)
 
+# Prometheus文本格式的延迟统计
+@get('/metrics')
+async def getMetrics():
+    return web.Response(text=metrics.render(), content_type='text/plain')
+
 @get('/logout')
 def logout(request):
     r = web.HTTPFound('/')
@@ -92,9 +263,19 @@ def check_admin(request):
     if not request.__user__:
         raise APIPermissionError()
 
-from configs import configs
 import time
 
+def page_size(size):
+    if not size:
+        return configs.page.size
+    try:
+        size = int(size)
+    except ValueError:
+        raise APIValueError('size', 'size must be an integer')
+    if size < 1:
+        raise APIValueError('size', 'size must be positive')
+    return min(size, configs.page.max_size)
+
 def make_session(user):
     # make session cookie:
     r = web.Response()
@@ -102,7 +283,7 @@ def make_session(user):
     r.set_cookie(configs.session.cookie_name, user2cookie(user, time.time() + expire), max_age=expire, httponly=True)
     user.password = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = dumps(user)
     return r
 
 def user2cookie(user, expire):
@@ -111,9 +292,24 @@ def user2cookie(user, expire):
     L = [user.user_id, str(expire), hashlib.sha1(key.encode('utf-8')).hexdigest()]
     return '-'.join(L)
 
+# 已经验证过的session缓存，key为cookie字符串，过期时间就是cookie本身的过期时间
+# 这样每个session在有效期内只需要查一次数据库
+sessions_cache = LRUCache(configs.session.cache_size)
+
+# user被修改或者删除后（比如修改了密码），该user的所有session都要重新验证
+def _evict_sessions(action, user):
+    user_id = user.user_id
+    sessions_cache.evict(lambda cookie_str, u: u.user_id == user_id)
+
+dao.on_change(User.__table__, _evict_sessions)
+
 async def cookie2user(cookie_str):
     if not cookie_str:
         return None
+    user = sessions_cache.get(cookie_str)
+    if user is not None:
+        # 返回副本，避免URL处理函数修改缓存中的user
+        return User(**user)
     try:
         L = cookie_str.split('-')
         if len(L) != 3:
@@ -121,7 +317,9 @@ async def cookie2user(cookie_str):
         user_id, expire, key = L
         if float(expire) < time.time():
             return None
-        user = await User.findByKey(user_id)
+        # 验证结果会被缓存，从主库读，保证修改过密码之后旧的cookie不能通过验证
+        with dao.on_primary():
+            user = await User.findByKey(user_id)
         if user is None:
             return None
         # 对从数据库中取出的user进行加密，然后与cookie中的信息对比
@@ -130,7 +328,8 @@ async def cookie2user(cookie_str):
             logging.info('invalid user')
             return None
         user.password = '******'
-        return user
+        sessions_cache.set(cookie_str, user, float(expire))
+        return User(**user)
     except Exception as e:
         logging.exception(e)
         return None
\ No newline at end of file
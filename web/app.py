@@ -3,41 +3,94 @@
 
 from webframe import add_route, add_routes, add_static
 from middlewares import response_factory, authenticate
-import dao
+from compress import compress_factory
+import dao, model
 
-import os
+import os, sys, time, signal, socket, select, argparse, subprocess
 import asyncio
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from configs import configs
 
 import logging
 logging.basicConfig(level=logging.INFO)
 
+# 新的worker开始监听之前最多等待的秒数
+READY_TIMEOUT = 30.0
 
-async def init(loop):
+
+# 创建app并开始监听，返回app，app中保存了handler和server，用于shutdown
+# reuse_port=True时设置SO_REUSEPORT，多个worker进程可以监听同一个端口，由内核分配连接
+# sock不为None时直接使用这个已经在监听的socket（比如从pymonitor继承来的）
+async def init(loop, reuse_port=False, sock=None):
     path = os.getcwd()
-    app = web.Application(loop=loop, middlewares=[response_factory, authenticate])
-    await dao.create_connection(loop, db='diet_pal')
+    middlewares = [compress_factory, response_factory, authenticate]
+    # 开启profiler时它在response_factory外面，这样序列化和模板渲染也算在请求之内；关闭时不安装，没有任何开销
+    if configs.profile.enabled:
+        import profiler
+        middlewares.insert(1, profiler.profile_factory)
+    app = web.Application(loop=loop, middlewares=middlewares)
+    # 每个进程有自己的连接池，所以数据库的总连接数是 workers * maxsize
+    await dao.create_connection(loop, db='diet_pal', minsize=configs.db.minsize, maxsize=configs.db.maxsize,
+                                replicas=configs.db.replicas, read_your_writes=configs.db.read_your_writes,
+                                backend=configs.db.backend, path=configs.db.path)
+    if configs.db.backend == 'sqlite':
+        await dao.create_tables(*model.MODELS)
+    else:
+        # 已有的MySQL数据库中没有后来加的daily_summary表（写入Record时要同时写入它）和record的分页索引
+        await dao.create_tables(model.DailySummary, model.Record)
     # 初始化Jinja2，这里值得注意是设置文件路径的path参数
-    init_jinja2(app, path=path+r'/templates')#,filters=dict(datetime=datetime_filter))
+    init_jinja2(app, path=path+r'/templates', debug=configs.debug, cache_dir=configs.template.cache_dir)#,filters=dict(datetime=datetime_filter))
     add_routes(app, 'controller')
     add_routes(app, 'apis')
+    if configs.profile.enabled:
+        add_routes(app, 'profiler')
+        app['__lag_watcher__'] = profiler.start_lag_watcher(loop)
     add_static(app)
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
-    logging.info('Server started at http://127.0.0.1:9000...')
-    return srv
+    host, port = configs.server.host, configs.server.port
+    handler = app.make_handler()
+    if sock is not None:
+        host, port = sock.getsockname()[:2]
+        srv = await loop.create_server(handler, sock=sock)
+    else:
+        srv = await loop.create_server(handler, host, port, reuse_port=reuse_port or None)
+    app['__handler__'] = handler
+    app['__server__'] = srv
+    logging.info('Server started at http://%s:%s...' % (host, port))
+    return app
+
+# 优雅地关闭：不再接受新连接，等待正在处理的请求完成，然后关闭连接池
+async def shutdown(app, timeout=10.0):
+    srv = app['__server__']
+    srv.close()
+    await srv.wait_closed()
+    if '__lag_watcher__' in app:
+        app['__lag_watcher__'].cancel()
+    await app.shutdown()
+    await app['__handler__'].shutdown(timeout)
+    await app.cleanup()
+    await dao.close_connection()
 
 # 初始化jinja2，以便其他函数使用jinja2模板
+# debug=False时为生产模式：不检查模板文件是否修改，编译结果缓存在cache_dir中，并在启动时预编译所有模板，
+# 这样第一个请求也不需要编译模板，新启动的进程直接从磁盘读取字节码
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
+    debug = kw.get('debug', True)
     options = dict(
         autoescape = kw.get('autoescape', True),
         block_start_string = kw.get('block_start_string', '{%'),
         block_end_string = kw.get('block_end_string', '%}'),
         variable_start_string = kw.get('variable_start_string', '{{'),
         variable_end_string = kw.get('variable_end_string', '}}'),
-        auto_reload = kw.get('auto_reload', True)
+        auto_reload = kw.get('auto_reload', debug)
     )
+    if not debug:
+        cache_dir = kw.get('cache_dir', None)
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.jinja2_cache')
+        os.makedirs(cache_dir, exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(cache_dir)
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
@@ -47,11 +100,166 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    if not debug:
+        templates = env.list_templates(extensions=['html'])
+        for name in templates:
+            env.get_template(name)
+        logging.info('precompiled %s templates.' % len(templates))
     app['__templating__'] = env
 
 
-if __name__ == '__main__':
+# 运行直到收到SIGTERM（或者Ctrl-C），然后优雅地退出
+# ready_fd是父进程（pymonitor）传来的管道，启动完成、可以处理请求之后写入一行ready
+def run(reuse_port=False, sock=None, ready_fd=None):
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(init(loop))
-    loop.run_forever()
+    app = loop.run_until_complete(init(loop, reuse_port=reuse_port, sock=sock))
+    if ready_fd is not None:
+        os.write(ready_fd, b'ready\n')
+        os.close(ready_fd)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGHUP, invalidate_caches)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info('Process %s shutting down...' % os.getpid())
+        # 关闭的过程中再收到的SIGTERM忽略，否则loop.stop会中断shutdown，连接池和WriteBuffer来不及关闭
+        loop.add_signal_handler(signal.SIGTERM, lambda: logging.info('Already shutting down.'))
+        loop.run_until_complete(shutdown(app))
+        loop.close()
+
+# SIGHUP：数据库被其他进程修改之后（比如import_foods.py导入了食物），让所有表的缓存和ETag失效
+# 多进程模式下SIGHUP由supervisor处理（重启所有worker），不会发到这里
+def invalidate_caches():
+    logging.info('SIGHUP received, invalidating caches...')
+    dao.invalidate(*[m.__table__ for m in model.MODELS])
+
+# worker进程：SIGINT（Ctrl-C会发给整个进程组）交给supervisor处理
+def run_worker(ready_fd=None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run(reuse_port=True, ready_fd=ready_fd)
+
+# 多进程模式的supervisor：启动n个worker，worker意外退出时重新启动，
+# 收到SIGHUP时逐个启动新的worker再关闭旧的（代码也会重新载入），收到SIGTERM/SIGINT时关闭所有worker后退出
+# 每个worker有自己的缓存（sessions_cache、foods_cache等）和表的版本号，只知道本进程内的写操作，
+# 所以其他worker的写入最多在configs.etag.window秒之后才会反映到ETag上，食物数据的修改需要SIGHUP才能让所有worker看到
+# 同一批启动的worker使用相同的ETag epoch（环境变量DIETPAL_EPOCH），这样没有写入过的表在所有worker上的ETag相同
+class Supervisor(object):
+    def __init__(self, workers):
+        self.workers = workers
+        self.children = dict()  # pid -> (Popen, 启动时间)
+        self.restarting = False
+        self.stopping = False
+
+    # 新的一批worker使用新的ETag epoch，它们的版本号都从0开始
+    def new_epoch(self):
+        os.environ['DIETPAL_EPOCH'] = '%d-%f' % (os.getpid(), time.time())
+
+    # wait_ready=True时通过--ready-fd的管道等待worker开始监听，超时或者启动失败时返回None
+    def spawn(self, wait_ready=False):
+        args = [sys.executable, os.path.abspath(__file__), '--worker']
+        if not wait_ready:
+            p = subprocess.Popen(args)
+        else:
+            r, w = os.pipe()
+            p = subprocess.Popen(args + ['--ready-fd', str(w)], pass_fds=(w,))
+            os.close(w)
+            ready = False
+            try:
+                if select.select([r], [], [], READY_TIMEOUT)[0]:
+                    ready = os.read(r, 16).startswith(b'ready')
+            finally:
+                os.close(r)
+            if not ready:
+                logging.error('Worker %s failed to start.' % p.pid)
+                self.stop(p)
+                return None
+        self.children[p.pid] = (p, time.time())
+        logging.info('Started worker %s.' % p.pid)
+        return p
+
+    def stop(self, p, timeout=15.0):
+        p.send_signal(signal.SIGTERM)
+        self.wait(p, timeout)
+
+    # 等待已经收到SIGTERM的worker退出，超时再kill
+    # 不要重复发送SIGTERM，worker在关闭的过程中会忽略它
+    def wait(self, p, timeout=15.0):
+        try:
+            p.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logging.warning('Worker %s did not exit in time, killing it.' % p.pid)
+            p.kill()
+            p.wait()
+
+    # 新的worker开始监听之后才关闭旧的，新旧worker同时监听同一个端口，所以重启期间不会拒绝新的连接
+    # 注意内核按SO_REUSEPORT分配给旧worker、但还没有被accept的连接在旧worker关闭监听时会被重置，
+    # worker一直在accept，这样的连接很少，但是不能完全避免
+    # 新的worker启动失败时保留剩下的旧worker
+    def reload(self):
+        self.new_epoch()
+        for pid in list(self.children):
+            if self.spawn(wait_ready=True) is None:
+                logging.error('Reload aborted, keep the running workers.')
+                return
+            old, _ = self.children.pop(pid)
+            self.stop(old)
+
+    def reap(self):
+        for pid, (p, started) in list(self.children.items()):
+            if p.poll() is None:
+                continue
+            del self.children[pid]
+            logging.warning('Worker %s exited with code %s, restarting...' % (pid, p.returncode))
+            # 启动后马上崩溃的话稍等一下，避免不停地重启
+            if time.time() - started < 1.0:
+                time.sleep(1.0)
+            self.spawn()
+
+    def run(self):
+        def on_stop(signum, frame):
+            self.stopping = True
+        def on_reload(signum, frame):
+            self.restarting = True
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_reload)
+        logging.info('Supervisor %s starting %s workers...' % (os.getpid(), self.workers))
+        self.new_epoch()
+        for i in range(self.workers):
+            self.spawn()
+        while not self.stopping:
+            if self.restarting:
+                self.restarting = False
+                logging.info('Reloading workers...')
+                self.reload()
+            self.reap()
+            time.sleep(0.5)
+        logging.info('Stopping workers...')
+        for p, _ in self.children.values():
+            p.send_signal(signal.SIGTERM)
+        for p, _ in list(self.children.values()):
+            self.wait(p)
+        self.children.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=configs.server.workers,
+                        help='number of worker processes, 0 for one per CPU')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    # 以下两个参数由pymonitor使用：继承的监听socket，以及通知启动完成的管道
+    parser.add_argument('--fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--ready-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    workers = args.workers or os.cpu_count()
+    if args.fd is not None:
+        run(sock=socket.socket(fileno=args.fd), ready_fd=args.ready_fd)
+    elif args.worker:
+        run_worker(ready_fd=args.ready_fd)
+    elif workers > 1:
+        Supervisor(workers).run()
+    else:
+        run()
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# dao.select/dao.execute每次查询在python这一层的CPU开销
+# 用一个不访问网络的假连接池代替aiomysql，所以测到的只是dao本身的开销，
+# legacy_*是改动之前的实现，用来对比
+# 用法: python3 benchmarks/bench_dao.py [查询次数]
+
+import os, sys, time, asyncio, logging
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiomysql
+import dao
+from model import Food
+
+# 和app.py一样输出INFO级别的日志，只是写到/dev/null
+logging.basicConfig(level=logging.INFO, stream=open(os.devnull, 'w'))
+
+ROW = dict(food_id=1, food_name='鸡蛋', unit=100.0, unit_name='g', energy=144.0, carbohydrate=2.8, protein=13.3, fat=8.8)
+
+class FakeCursor(object):
+    def __init__(self):
+        self.closed = False
+        self.rowcount = 0
+        self.description = [(k,) for k in ROW]
+
+    async def execute(self, sql, args):
+        self.rowcount = 1
+
+    async def fetchall(self):
+        return [dict(ROW)]
+
+    async def fetchmany(self, size):
+        return [dict(ROW)]
+
+    async def close(self):
+        self.closed = True
+
+class FakeConnection(object):
+    async def cursor(self, *args):
+        return FakeCursor()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+class FakePool(object):
+    def __init__(self):
+        self._conn = FakeConnection()
+
+    def acquire(self):
+        return self._conn
+
+async def legacy_select(pool, sql, args, size=None):
+    logging.info('SQL: %s' % sql)
+    async with pool.acquire() as connection:
+        cur = await connection.cursor(aiomysql.DictCursor)
+        await cur.execute(sql.replace('?', '%s'), args or ())
+        if size:
+            rs = await cur.fetchmany(size)
+        else:
+            rs = await cur.fetchall()
+        await cur.close()
+        return rs
+
+async def legacy_execute(pool, sql, args):
+    logging.info('SQL: %s' % sql)
+    async with pool.acquire() as connection:
+        cur = await connection.cursor(aiomysql.DictCursor)
+        await cur.execute(sql.replace('?', '%s'), args or ())
+        return cur.rowcount
+
+async def run(name, fn, n):
+    start = time.process_time()
+    for i in range(n):
+        await fn()
+    cost = time.process_time() - start
+    print('%-16s %8.2f us/query' % (name, cost / n * 1e6))
+
+async def main(n):
+    pool = FakePool()
+    setattr(dao, '__pool', pool)
+    setattr(dao, '__backend', dao.MySQLBackend())
+    by_key = '%s where `%s`=?' % (Food.__select__, Food.__primary_key__)
+    update = Food.__update__.replace('%s', '?')
+    args = [1, '鸡蛋', 100.0, 'g', 144.0, 2.8, 13.3, 8.8]
+    await run('legacy select', lambda: legacy_select(pool, by_key, [1], 1), n)
+    await run('select', lambda: dao.select(Food.__select_key__, [1], 1), n)
+    await run('legacy execute', lambda: legacy_execute(pool, update, args), n)
+    await run('execute', lambda: dao.execute(Food.__update__, args), n)
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    asyncio.get_event_loop().run_until_complete(main(n))
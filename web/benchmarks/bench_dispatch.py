@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# RequestHandler处理一个请求的开销：从request中绑定参数、调用URL处理函数、记录metrics，即整个__call__
+# 使用aiohttp的make_mocked_request构造真实的request（不经过网络），每次请求都是新的request对象，
+# 所以request.query的解析也计算在内
+# legacy是改动之前每次请求都判断HTTP方法、解析query string、复制dict的实现
+# 用法: python3 benchmarks/bench_dispatch.py [请求次数]
+
+import os, sys, time, asyncio, logging
+from urllib import parse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp.test_utils import make_mocked_request
+from webframe import RequestHandler, get, APIError
+import metrics
+
+class LegacyRequestHandler(RequestHandler):
+    async def __call__(self, request):
+        start = time.perf_counter()
+        try:
+            return await self.handle(request)
+        finally:
+            metrics.request_seconds.observe(self._labels, time.perf_counter() - start)
+
+    async def handle(self, request):
+        kw = None
+        if self._has_var_kw_args or self._has_named_kw_args or self._required_kw_args:
+            if request.method == 'GET':
+                qs = request.query_string
+                if qs:
+                    kw = dict()
+                    for k, v in parse.parse_qs(qs, True).items():
+                        kw[k] = v[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if not self._has_var_kw_args and self._named_kw_args:
+                copy = dict()
+                for name in self._named_kw_args:
+                    if name in kw:
+                        copy[name] = kw[name]
+                kw = copy
+            for k, v in request.match_info.items():
+                if k in kw:
+                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+                kw[k] = v
+        if self._has_request_args:
+            kw['request'] = request
+        if self._required_kw_args:
+            for name in self._required_kw_args:
+                if not name in kw:
+                    return None
+        try:
+            r = await self._func(**kw)
+            return r
+        except APIError as e:
+            return dict(error=e.error, data=e.data, message=e.message)
+
+@get('/')
+async def index(request):
+    return None
+
+@get('/api/foods')
+async def foods(*, after=None, size=None):
+    return None
+
+@get('/api/records')
+async def records(request, *, after=None, size=None):
+    return None
+
+@get('/api/foods/{food_id}')
+async def food(food_id):
+    return None
+
+CASES = [
+    ('no args', index, '/', dict()),
+    ('named kw', foods, '/api/foods?after=MTA&size=20&_=1539850000', dict()),
+    ('request + kw', records, '/api/records?size=50', dict()),
+    ('match_info', food, '/api/foods/42', dict(food_id='42')),
+]
+
+async def run(handler, path, match_info, n):
+    # make_mocked_request很慢，构造一个之后clone（clone出的request会重新解析query），事先构造好，只测量handler的耗时
+    request = make_mocked_request('GET', path, match_info=match_info)
+    requests = [request.clone() for i in range(n)]
+    start = time.perf_counter()
+    for request in requests:
+        await handler(request)
+    return (time.perf_counter() - start) / n
+
+async def main(n):
+    for name, fn, path, match_info in CASES:
+        legacy = await run(LegacyRequestHandler(None, fn), path, match_info, n)
+        new = await run(RequestHandler(None, fn), path, match_info, n)
+        print('%-14s legacy %6.2f us, compiled %6.2f us (%.2fx)' % (name, legacy * 1e6, new * 1e6, legacy / new))
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    asyncio.get_event_loop().run_until_complete(main(n))
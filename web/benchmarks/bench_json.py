@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 序列化Food和Record列表的耗时：改动之前response_factory中的json.dumps（那时Model是dict的子类）与serializer.dumps的对比，
+# serializer分别序列化Model对象的list和Model.find(as_dicts=True)返回的dict的list
+# 用法: python3 benchmarks/bench_json.py [行数]
+
+import os, sys, time, json, random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import Food, Record
+import serializer
+
+# 改动之前的Model是dict的子类，json.dumps直接把它当作dict编码
+class LegacyModel(dict):
+    pass
+
+def legacy_dumps(o):
+    return json.dumps(o, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8')
+
+def make_rows(n):
+    foods = [(i, '鸡蛋%d' % i, 100.0, 'g', random.uniform(0, 900), random.uniform(0, 100),
+              random.uniform(0, 100), random.uniform(0, 100)) for i in range(n)]
+    records = [('%050d' % i, i, '%050d' % 1, random.uniform(0, 500), time.time()) for i in range(n)]
+    return dict(foods=(Food, foods), records=(Record, records))
+
+def bench(name, fn, obj, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(obj)
+    return (time.perf_counter() - start) / repeat
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print('encoder: %s' % ('orjson' if serializer.orjson else 'json'))
+    for name, (model, rows) in make_rows(n).items():
+        legacy = bench(name, legacy_dumps, {name: [LegacyModel(zip(model.__columns__, r)) for r in rows]}, 20)
+        models = bench(name, serializer.dumps, {name: list(map(model.from_row, rows))}, 20)
+        dicts = bench(name, serializer.dumps, {name: list(map(model.dict_from_row, rows))}, 20)
+        print('%d %-8s legacy %8.2f ms, serializer %8.2f ms (%.1fx), as_dicts %8.2f ms (%.1fx)' % (
+            n, name, legacy * 1000, models * 1000, legacy / models, dicts * 1000, legacy / dicts))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Model对象的内存占用和构造耗时：改动之前dict子类的Model（由DictCursor的dict构造）与
+# 现在__slots__的Model（由tuple构造）的对比，另外还有属性访问和序列化的耗时，
+# CatalogCache缓存的dict的序列化耗时，以及从查询结果到JSON的总耗时（只输出JSON的查询用的是as_dicts=True）
+# 用法: python3 benchmarks/bench_model.py [行数]
+
+import os, sys, time, random, tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import Food, Record
+import serializer
+
+# 改动之前的Model，只保留构造和属性访问相关的部分
+class LegacyModel(dict):
+    def __init__(self, **kw):
+        super(LegacyModel, self).__init__(**kw)
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            return None
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+class LegacyFood(LegacyModel):
+    pass
+
+class LegacyRecord(LegacyModel):
+    pass
+
+def make_rows(n):
+    foods = [(i, '鸡蛋%d' % i, 100.0, 'g', random.uniform(0, 900), random.uniform(0, 100),
+              random.uniform(0, 100), random.uniform(0, 100)) for i in range(n)]
+    records = [('%050d' % i, i, '%050d' % 1, random.uniform(0, 500), time.time()) for i in range(n)]
+    return foods, records
+
+# DictCursor返回的结果，用来构造LegacyModel
+def as_dicts(model, rows):
+    return [dict(zip(model.__columns__, r)) for r in rows]
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    objs = build()
+    cost = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return objs, cost, size
+
+def timeit(fn, repeat=5):
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+def compare(name, model, legacy, rows):
+    n = len(rows)
+    dicts_from_cursor = dicts = as_dicts(model, rows)
+    old, old_cost, old_size = measure(lambda: [legacy(**r) for r in dicts])
+    new, new_cost, new_size = measure(lambda: list(map(model.from_row, rows)))
+    print('%d %-8s memory      legacy %8.1f B/row, slots %8.1f B/row (%.1fx)' % (
+        n, name, old_size / n, new_size / n, old_size / new_size))
+    print('%d %-8s construct   legacy %8.2f ms,    slots %8.2f ms    (%.1fx)' % (
+        n, name, old_cost * 1000, new_cost * 1000, old_cost / new_cost))
+    column = model.__fields__[0]
+    old_get = timeit(lambda: [getattr(m, column) for m in old])
+    new_get = timeit(lambda: [getattr(m, column) for m in new])
+    print('%d %-8s attribute   legacy %8.2f ms,    slots %8.2f ms    (%.1fx)' % (
+        n, name, old_get * 1000, new_get * 1000, old_get / new_get))
+    old_json = timeit(lambda: serializer.dumps(old))
+    new_json = timeit(lambda: serializer.dumps(new))
+    print('%d %-8s serialize   legacy %8.2f ms,    slots %8.2f ms    (%.1fx)' % (
+        n, name, old_json * 1000, new_json * 1000, old_json / new_json))
+    # CatalogCache中事先转换好的dict（/api/foods返回的就是这些）
+    dicts = [m.to_dict() for m in new]
+    cached_json = timeit(lambda: serializer.dumps(dicts))
+    print('%d %-8s serialize   legacy %8.2f ms,    dicts %8.2f ms    (%.1fx)' % (
+        n, name, old_json * 1000, cached_json * 1000, old_json / cached_json))
+    # 从数据库驱动返回的结果开始：DictCursor的dict或者tuple
+    old_total = timeit(lambda: serializer.dumps([legacy(**r) for r in dicts_from_cursor]))
+    new_total = timeit(lambda: serializer.dumps(list(map(model.from_row, rows))))
+    as_dicts_total = timeit(lambda: serializer.dumps(list(map(model.dict_from_row, rows))))
+    print('%d %-8s row to JSON legacy %8.2f ms,    slots %8.2f ms    (%.1fx), as_dicts %8.2f ms (%.1fx)' % (
+        n, name, old_total * 1000, new_total * 1000, old_total / new_total,
+        as_dicts_total * 1000, old_total / as_dicts_total))
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('encoder: %s' % ('orjson' if serializer.orjson else 'json'))
+    foods, records = make_rows(n)
+    compare('foods', Food, LegacyFood, foods)
+    compare('records', Record, LegacyRecord, records)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# MealPlanner.plan在不同大小的食物库上的耗时，食物是随机生成的，不需要数据库
+# 用法: python3 benchmarks/bench_planner.py [最大食物数量]
+
+import os, sys, time, random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import Food
+from planner import MealPlanner
+
+def make_foods(n):
+    foods = []
+    for i in range(n):
+        foods.append(Food(food_id=i, food_name='food%d' % i, unit=100.0, unit_name='g',
+                          energy=random.uniform(0, 900), carbohydrate=random.uniform(0, 100),
+                          protein=random.uniform(0, 100), fat=random.uniform(0, 100)))
+    return foods
+
+def bench(n, repeat=20):
+    planner = MealPlanner()
+    start = time.perf_counter()
+    planner.load(make_foods(n))
+    load = time.perf_counter() - start
+    targets = dict(energy=700, protein=40, fat=20, carbohydrate=90)
+    start = time.perf_counter()
+    for i in range(repeat):
+        planner.plan(targets, size=3, count=5)
+    cost = (time.perf_counter() - start) / repeat
+    print('%8d foods: load %8.2f ms, plan %8.3f ms' % (n, load * 1000, cost * 1000))
+
+if __name__ == '__main__':
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    n = 100
+    while n <= limit:
+        bench(n)
+        n *= 10
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 端到端的压力测试：在子进程中用app.init启动服务器（SQLite后端，预先写入食物数据），
+# 然后用aiohttp的client模拟多个用户：注册、登录，之后混合访问/home、/api/foods、POST /api/record、/api/records
+# 结果以JSON输出：总的以及每个接口的requests/sec、p50/p95/p99延迟（毫秒），以及服务器端的连接池等待时间
+# 用法: python3 benchmarks/loadtest.py --concurrency 50 --duration 30 --output result.json
+
+import os, sys, json, time, random, socket, hashlib, argparse, asyncio, subprocess, multiprocessing, tempfile, logging
+WEB = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WEB)
+
+import aiohttp
+
+# 每个虚拟用户登录之后按权重随机选择下一个请求
+MIX = [
+    ('GET /home', 2),
+    ('GET /api/foods', 4),
+    ('POST /api/record', 2),
+    ('GET /api/records', 2),
+]
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+async def seed(path, foods):
+    import dao, model
+    from model import Food
+    await dao.create_connection(None, backend='sqlite', path=path)
+    await dao.create_tables(*model.MODELS)
+    rows = [Food(food_id=i, food_name='食物%d' % i, unit=100.0, unit_name='g', energy=random.uniform(0, 900),
+                 carbohydrate=random.uniform(0, 100), protein=random.uniform(0, 100), fat=random.uniform(0, 100))
+            for i in range(1, foods + 1)]
+    await Food.save_many(rows)
+    await dao.close_connection()
+
+# 子进程：使用临时的SQLite数据库启动app，和app.py一样运行在web目录下
+def serve(path, port, maxsize, group_commit=False):
+    os.chdir(WEB)
+    logging.basicConfig(level=logging.WARNING)
+    from configs import configs
+    configs.db.backend = 'sqlite'
+    configs.db.path = path
+    configs.db.maxsize = maxsize
+    configs.db.group_commit.enabled = group_commit
+    configs.server.port = port
+    import app
+    app.run()
+
+async def wait_ready(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError('server did not start in %s seconds' % timeout)
+
+class VirtualUser(object):
+    def __init__(self, base, index, foods, stats):
+        self.base = base
+        self.index = index
+        self.foods = foods
+        self.stats = stats
+        # 服务器是127.0.0.1，CookieJar默认不接受IP地址的cookie
+        self.session = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True))
+
+    async def request(self, name, method, path, **kw):
+        start = time.perf_counter()
+        try:
+            async with self.session.request(method, self.base + path, **kw) as resp:
+                body = await resp.read()
+                ok = resp.status < 400
+                # APIError（包括未登录）以200返回，内容是{"error": ...}
+                if ok and resp.content_type == 'application/json':
+                    result = json.loads(body)
+                    ok = not (isinstance(result, dict) and 'error' in result)
+        except (aiohttp.ClientError, ValueError):
+            ok = False
+        self.stats.setdefault(name, []).append((time.perf_counter() - start, ok))
+
+    async def login(self):
+        name = 'user%d_%d' % (os.getpid(), self.index)
+        password = hashlib.sha1(b'password').hexdigest()
+        await self.request('POST /api/user', 'POST', '/api/user',
+                           json=dict(username=name, password=password, email='%s@example.com' % name, phone=''))
+        await self.request('POST /api/authenticate', 'POST', '/api/authenticate',
+                           json=dict(useremail=name, password=password))
+
+    async def run(self, deadline):
+        names = [n for n, w in MIX]
+        weights = [w for n, w in MIX]
+        await self.login()
+        while time.time() < deadline:
+            name = random.choices(names, weights)[0]
+            if name == 'GET /home':
+                await self.request(name, 'GET', '/home')
+            elif name == 'GET /api/foods':
+                await self.request(name, 'GET', '/api/foods?size=%d' % random.choice((20, 50, 100)))
+            elif name == 'POST /api/record':
+                await self.request(name, 'POST', '/api/record', json=dict(
+                    food_id=random.randint(1, self.foods), amount=random.uniform(10, 300), record_time=None))
+            else:
+                await self.request(name, 'GET', '/api/records')
+
+    async def close(self):
+        await self.session.close()
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def summarize(samples, elapsed):
+    latencies = sorted(s for s, ok in samples)
+    errors = sum(1 for s, ok in samples if not ok)
+    return dict(
+        requests=len(samples),
+        errors=errors,
+        rps=round(len(samples) / elapsed, 2),
+        p50_ms=round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        p95_ms=round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        p99_ms=round(percentile(latencies, 0.99) * 1000, 3) if latencies else None)
+
+# 从/metrics中读取连接池等待时间的直方图
+def parse_pool_wait(text):
+    count, total, buckets = 0, 0.0, []
+    for line in text.splitlines():
+        if line.startswith('dietpal_pool_wait_seconds_bucket'):
+            le = line.split('le="')[1].split('"')[0]
+            buckets.append((float(le), int(line.rsplit(' ', 1)[1])))
+        elif line.startswith('dietpal_pool_wait_seconds_sum'):
+            total = float(line.rsplit(' ', 1)[1])
+        elif line.startswith('dietpal_pool_wait_seconds_count'):
+            count = int(line.rsplit(' ', 1)[1])
+    # p95只能精确到bucket的上界
+    p95 = next((le for le, n in buckets if count and n >= count * 0.95), None)
+    return dict(waits=count, mean_ms=round(total / count * 1000, 3) if count else None,
+                p95_le_ms=p95 * 1000 if p95 is not None and p95 != float('inf') else p95)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=WEB, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+async def load(port, args):
+    base = 'http://127.0.0.1:%d' % port
+    await wait_ready(port)
+    stats = dict()
+    users = [VirtualUser(base, i, args.foods, stats) for i in range(args.concurrency)]
+    start = time.time()
+    await asyncio.gather(*[u.run(start + args.duration) for u in users])
+    elapsed = time.time() - start
+    async with users[0].session.get(base + '/metrics') as resp:
+        pool_wait = parse_pool_wait(await resp.text())
+    for u in users:
+        await u.close()
+    traffic = [s for name, samples in stats.items() for s in samples]
+    return dict(
+        commit=git_commit(),
+        concurrency=args.concurrency,
+        group_commit=args.group_commit,
+        duration=round(elapsed, 3),
+        foods=args.foods,
+        total=summarize(traffic, elapsed),
+        endpoints={name: summarize(samples, elapsed) for name, samples in sorted(stats.items())},
+        pool_wait=pool_wait)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=20, help='number of virtual users')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of traffic')
+    parser.add_argument('--foods', type=int, default=1000, help='number of seeded foods')
+    parser.add_argument('--pool-size', type=int, default=4, help='database connections of the server')
+    parser.add_argument('--group-commit', action='store_true', help='merge concurrent record inserts (dao.WriteBuffer)')
+    parser.add_argument('--output', help='write the JSON result to this file instead of stdout')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'loadtest.db')
+    asyncio.get_event_loop().run_until_complete(seed(path, args.foods))
+    port = free_port()
+    server = multiprocessing.get_context('spawn').Process(target=serve, args=(path, port, args.pool_size, args.group_commit))
+    server.start()
+    try:
+        result = asyncio.get_event_loop().run_until_complete(load(port, args))
+    finally:
+        server.terminate()
+        server.join()
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
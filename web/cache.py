@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 进程内的缓存，用来减少对数据库的重复查询
+
+import asyncio, logging, time, bisect
+from collections import OrderedDict
+import dao
+
+# 整张表的只读缓存，适用于像food这样数据量不大、几乎不修改但是读取非常频繁的表
+# 每次读取时比较dao中记录的表版本号，版本号变化（即有Model写入）时才重新select整张表
+# 除了Model以外还保存每一行的dict：Model序列化时要对每一行调用to_dict，直接返回dict的api（page的as_dicts=True）
+# 可以让orjson一次编码完，不需要回调Python
+class CatalogCache(object):
+    def __init__(self, model):
+        self._model = model
+        self._version = None
+        self._rows = []
+        self._dicts = []
+        self._keys = []
+        self._index = dict()
+        self._lock = asyncio.Lock()
+
+    async def _load(self):
+        table = self._model.__table__
+        if self._version == dao.table_version(table):
+            return
+        # 多个请求同时发现缓存失效时，只让一个去查数据库
+        async with self._lock:
+            version = dao.table_version(table)
+            if self._version == version:
+                return
+            logging.info('reload catalog cache of %s...' % table)
+            pk = self._model.__primary_key__
+            # 缓存会一直使用到下一次写入，所以从主库读，避免读到从库上还没有同步的旧数据
+            with dao.on_primary():
+                rows = await self._model.find(orderBy='`%s`' % pk)
+            self._rows = rows
+            self._dicts = [r.to_dict() for r in rows]
+            self._keys = [r[pk] for r in rows]
+            self._index = {r[pk]: r for r in rows}
+            # 使用查询之前的版本号，如果查询过程中有写入，下一次读取时会再次载入
+            self._version = version
+
+    def invalidate(self):
+        self._version = None
+
+    async def all(self):
+        await self._load()
+        return list(self._rows)
+
+    async def get(self, pk):
+        await self._load()
+        return self._index.get(pk)
+
+    # 与Model.findPage相同的keyset分页，游标格式也相同，但不需要查数据库
+    # as_dicts=True时返回每一行的dict，调用者不能修改
+    async def page(self, after=None, size=20, as_dicts=False):
+        await self._load()
+        start = 0
+        if after:
+            start = bisect.bisect_right(self._keys, dao.decode_cursor(after)[0])
+        rows = (self._dicts if as_dicts else self._rows)[start:start + size]
+        cursor = None
+        if start + size < len(self._rows):
+            cursor = dao.encode_cursor([self._keys[start + size - 1]])
+        return rows, cursor
+
+    # 批量按主键取，找不到的主键不会出现在返回的dict中
+    async def get_many(self, pks):
+        await self._load()
+        index = self._index
+        return {pk: index[pk] for pk in pks if pk in index}
+
+
+# 有容量上限的LRU缓存，每个条目带有自己的过期时间（time.time()的时间戳）
+class LRUCache(object):
+    def __init__(self, maxsize=1024):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expire, value = item
+        if expire < time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, expire):
+        self._data[key] = (expire, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        return item[1] if item else None
+
+    # 删除所有满足fn(key, value)的条目，返回删除的数量
+    def evict(self, fn):
+        keys = [k for k, (_, v) in self._data.items() if fn(k, v)]
+        for k in keys:
+            del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
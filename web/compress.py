@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 响应压缩：根据Accept-Encoding选择brotli或者gzip，只压缩超过阈值的文本类响应（JSON、HTML等）
+# 静态文件不在请求时压缩，而是事先用这个模块的命令行生成.br/.gz文件，由webframe.add_static直接返回
+# 安装了brotli时优先使用brotli，否则只用gzip
+# 命令行用法: python3 compress.py [静态文件目录]
+
+import os, sys, gzip, logging
+from aiohttp import web
+from configs import configs
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 按优先级排列
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# 需要压缩的Content-Type，图片、字体等已经压缩过的格式不在其中
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+# 需要预压缩的静态文件
+PRECOMPRESS = ('.js', '.css', '.html', '.json', '.svg', '.txt', '.map', '.ttf', '.otf', '.eot', '.ico')
+
+# 不同的Accept-Encoding只有几种，解析的结果缓存起来，超过上限时直接清空
+MAX_HEADERS = 256
+_accepted = dict()
+
+# Accept-Encoding中q>0的编码，'*'表示接受任何编码
+def accepted(header):
+    codings = _accepted.get(header)
+    if codings is None:
+        codings = set()
+        for part in header.split(','):
+            name, _, params = part.partition(';')
+            name = name.strip().lower()
+            q = 1.0
+            params = params.strip().replace(' ', '')
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            if name and q > 0:
+                codings.add(name)
+        if '*' in codings:
+            codings.update(SUFFIXES)
+        if len(_accepted) >= MAX_HEADERS:
+            _accepted.clear()
+        codings = _accepted[header] = frozenset(codings)
+    return codings
+
+# 返回客户端接受的、available中优先级最高的编码，都不接受时返回None
+def negotiate(header, available=ENCODINGS):
+    if not header:
+        return None
+    codings = accepted(header)
+    for c in available:
+        if c in codings:
+            return c
+    return None
+
+# best=True用于预压缩，不在乎耗时，使用最高的压缩率
+def compress(data, coding, best=False):
+    if coding == 'br':
+        return brotli.compress(data, quality=11 if best else configs.compress.brotli_quality)
+    return gzip.compress(data, compresslevel=9 if best else configs.compress.gzip_level)
+
+def is_compressible(content_type):
+    return content_type.startswith(COMPRESSIBLE)
+
+def add_vary(resp, header):
+    vary = resp.headers.get('Vary')
+    if not vary:
+        resp.headers['Vary'] = header
+    elif header.lower() not in vary.lower():
+        resp.headers['Vary'] = '%s, %s' % (vary, header)
+
+# 压缩response_factory生成的响应，放在middlewares的最外层
+# StreamResponse（流式的JSON、静态文件）不经过这里：流式JSON在stream_json中由aiohttp边写边压缩，静态文件使用预压缩的文件
+async def compress_factory(app, handler):
+    async def compress_middleware(request):
+        r = await handler(request)
+        if not isinstance(r, web.Response) or r.prepared or 'Content-Encoding' in r.headers:
+            return r
+        body = r.body
+        if not isinstance(body, bytes) or len(body) < configs.compress.threshold:
+            return r
+        if not is_compressible(r.content_type):
+            return r
+        add_vary(r, 'Accept-Encoding')
+        coding = negotiate(request.headers.get('Accept-Encoding'))
+        if coding is None:
+            return r
+        r.body = compress(body, coding)
+        r.headers['Content-Encoding'] = coding
+        return r
+    return compress_middleware
+
+# 对于root下的每一个文本类静态文件，生成压缩后的.br/.gz文件
+# 已经存在且比原文件新的跳过，压缩之后没有变小的不生成
+def precompress(root):
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(PRECOMPRESS):
+                continue
+            path = os.path.join(dirpath, name)
+            mtime = os.path.getmtime(path)
+            with open(path, 'rb') as f:
+                data = None
+                for coding in ENCODINGS:
+                    target = path + SUFFIXES[coding]
+                    if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+                        continue
+                    if data is None:
+                        data = f.read()
+                    compressed = compress(data, coding, best=True)
+                    if len(compressed) >= len(data):
+                        continue
+                    # 先写临时文件再改名，正在运行的服务器不会读到写了一半的文件
+                    with open(target + '.tmp', 'wb') as out:
+                        out.write(compressed)
+                    os.replace(target + '.tmp', target)
+                    count += 1
+                    logging.info('%s: %d -> %d bytes' % (target, len(data), len(compressed)))
+    logging.info('precompressed %d files.' % count)
+    return count
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if brotli is None:
+        logging.warning('brotli is not installed, only .gz files are generated.')
+    precompress(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
@@ -1,21 +1,97 @@
 # Default Configuration
 
 configs = {
+    # debug模式下模板每次渲染前检查文件是否修改；关闭后模板在启动时预编译，并缓存字节码到磁盘
+    'debug': True,
     'server': {
         'host': '127.0.0.1',
-        'port': 9000
+        'port': 9000,
+        # worker进程数，1为单进程，0为每个CPU一个
+        # 缓存（登录session、食物数据等）和ETag用的表版本号是每个进程各自的，其他worker的写入不会让它们失效：
+        # session最多在过期之前仍然有效，ETag最多在etag.window秒之后更新，食物数据在SIGHUP重启worker之后才更新
+        'workers': 1
     },
     'db': {
+        # 'mysql'或者'sqlite'，sqlite不需要数据库服务器，数据保存在path指定的文件中，启动时自动建表
+        'backend': 'mysql',
+        'path': 'diet_pal.db',
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': 'password',
-        'database': 'diet-pal'
+        'database': 'diet-pal',
+        # 每个进程的连接池大小
+        'minsize': 1,
+        'maxsize': 10,
+        # 从库，读操作轮流分配到从库上，每一项中没有给出的参数与主库相同，比如:
+        # [{'host': '127.0.0.1', 'port': 3307}, {'host': '127.0.0.1', 'port': 3308}]
+        'replicas': [],
+        # 一个请求写入之后，这个请求接下来的读操作都走主库
+        'read_your_writes': True,
+        # 把同时进行的Record写入合并成批量insert（dao.WriteBuffer），delay秒或者max_rows行写一次
+        'group_commit': {
+            'enabled': False,
+            'delay': 0.005,
+            'max_rows': 100
+        }
     },
     'session': {
         'cookie_name': 'DietPal',
         'secret': 'jh6iuhbv1',
-        'expire': 3600
+        'expire': 3600,
+        'cache_size': 1024
+    },
+    'page': {
+        'size': 20,
+        'max_size': 100
+    },
+    'bulk': {
+        'max_size': 500
+    },
+    'plan': {
+        'max_size': 5,
+        'max_count': 10
+    },
+    'template': {
+        # 为None时使用web目录下的.jinja2_cache
+        'cache_dir': None
+    },
+    'metrics': {
+        # 超过这个时间（秒）的SQL会记录到日志中
+        'slow_query': 0.2
+    },
+    'compress': {
+        # 小于这个字节数的响应不压缩
+        'threshold': 1024,
+        # 动态压缩每个请求都要做一次，使用较快的压缩级别，预压缩的静态文件使用最高级别
+        'gzip_level': 6,
+        'brotli_quality': 4
+    },
+    'etag': {
+        # 版本号只记录本进程内的写操作，其他进程（多个worker、命令行工具）写入的数据最多在这么多秒之后
+        # 才能让ETag失效，为0时只由本进程的版本号决定（单进程部署）
+        'window': 60
+    },
+    'static': {
+        # 静态文件的Cache-Control: max-age（秒），debug模式下不缓存
+        'max_age': 31536000
+    },
+    'profile': {
+        # 为False时不安装profiler的middleware、/api/profiles和事件循环延迟的检测，没有任何开销
+        'enabled': False,
+        # 随机profile的请求比例，0为只profile带有header的请求
+        'sample': 0.0,
+        # 请求头header的值等于token时profile这个请求，查看/api/profiles也需要在这个请求头中带上token
+        # token为None时只有随机抽样，/api/profiles不能访问
+        'header': 'X-Profile',
+        'token': None,
+        # pstats文件保存的目录，None为web/.profiles，多个worker可以共用一个目录
+        'dir': None,
+        # 每个路由保留最近的多少个pstats文件
+        'keep': 20,
+        # 每隔这么多秒检测一次事件循环的延迟，超过slow_lag秒时写一条warning日志
+        'lag_interval': 0.5,
+        'slow_lag': 0.1
     }
 }
 
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from webframe import get, post
+from webframe import get, post, conditional
+from model import User, Food, Record
 import apis
 
 #编写用于测试的URL处理函数
@@ -25,10 +26,11 @@ def index(request):
     }
 
 @get('/home')
+@conditional(Food, User, per_user=True)
 async def home(request):
     # foods = await Macro_Nutrition.find()
-    # 调用api来得到数据，由于api要从数据库取数据，为了不阻塞服务器处理其他请求，这里需要异步
-    foods = (await apis.getAllFoods())['foods']
+    # 首页要展示全部食物，所以不走分页的api，直接从food的缓存中取
+    foods = await apis.foods_cache.all()
     return {
         '__template__': 'foods.html',
         'foods': foods,
@@ -48,6 +50,7 @@ def login():
     }
 
 @get('/records')
+@conditional(Record, User, per_user=True)
 async def records(request):
     records = (await apis.get_records(request))['records']
     return {
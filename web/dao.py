@@ -1,57 +1,536 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import asyncio, aiomysql, logging
-import time, uuid
+import asyncio, logging
+import time, uuid, json, base64, contextvars, contextlib
+import metrics
 
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+# 数据库后端：默认是MySQL（aiomysql），也可以在create_connection中用backend='sqlite'选择dao_sqlite中的SQLite后端
+# 后端提供连接池以及少量与SQL方言有关的功能，连接池的接口与aiomysql相同
+class MySQLBackend(object):
+    name = 'mysql'
+
+    def __init__(self):
+        if aiomysql is None:
+            raise ImportError('aiomysql is required for the mysql backend')
+        self.dict_cursor = aiomysql.DictCursor
+        self.stream_cursor = aiomysql.SSDictCursor
+        # Model使用tuple形式的结果，列的顺序由Model.__select__决定
+        self.tuple_cursor = aiomysql.Cursor
+        self.stream_tuple_cursor = aiomysql.SSCursor
+
+    async def create_pool(self, loop, **kwargs):
+        return await aiomysql.create_pool(
+            loop=loop,
+            host=kwargs.get('host', 'localhost'),
+            port=kwargs.get('port', 3306),
+            user=kwargs.get('user', 'root'),
+            password=kwargs.get('password','password'),
+            db=kwargs.get('db'),
+            charset=kwargs.get('charset', 'utf8'),
+            autocommit=kwargs.get('autocommit', True),
+            maxsize=kwargs.get('maxsize', 10),
+            minsize=kwargs.get('minsize', 1)
+        )
+
+    def compile(self, sql):
+        return sql.replace('?', '%s')
+
+    # 是否是连接出了问题，而不是SQL本身的错误（pymysql把很多服务器端的错误也作为OperationalError抛出，
+    # 比如1205锁等待超时、1241参数类型不对），只有前者才说明这个库不可用
+    # CR_*（2000-2999）是客户端的错误，比如2003连不上、2013连接断开
+    def is_connection_error(self, e):
+        if isinstance(e, (OSError, asyncio.TimeoutError)):
+            return True
+        if isinstance(e, aiomysql.OperationalError) and e.args and isinstance(e.args[0], int):
+            return 2000 <= e.args[0] < 3000
+        return False
+
+    # MySQL的create index不支持if not exists，先查一下索引是否已经存在
+    index_exists_sql = ('select 1 from information_schema.statistics '
+                        'where table_schema=database() and table_name=? and index_name=? limit 1')
+
+    # insert，主键已经存在时把increments中的列累加到原值上，updates中的列替换为新的值
+    def upsert_sql(self, table, pk, columns, increments=(), updates=()):
+        sets = ['`%s`=`%s`+values(`%s`)' % (c, c, c) for c in increments]
+        sets.extend('`%s`=values(`%s`)' % (c, c) for c in updates)
+        return 'insert into `%s` (%s) values (%s) on duplicate key update %s' % (
+            table, ', '.join('`%s`' % c for c in columns), ', '.join('?' for c in columns), ', '.join(sets))
+
+def _create_backend(name):
+    if name == 'sqlite':
+        from dao_sqlite import SQLiteBackend
+        return SQLiteBackend()
+    if name == 'mysql':
+        return MySQLBackend()
+    raise ValueError('Unknown database backend: %s' % name)
+
+__backend = None
+
+def backend():
+    return __backend
+
+def upsert_sql(table, pk, columns, increments=(), updates=()):
+    return __backend.upsert_sql(table, pk, columns, increments, updates)
+
+# 编译好的SQL语句缓存：调用方使用'?'作为占位符，驱动使用'%s'，每个语句只转换一次
+# 和连接池一起创建，语句的种类由代码决定，数量有限，超过上限时直接清空
+MAX_STATEMENTS = 1024
+__statements = dict()
+
+def compile_sql(sql):
+    stmt = __statements.get(sql)
+    if stmt is None:
+        if len(__statements) >= MAX_STATEMENTS:
+            __statements.clear()
+        stmt = __statements[sql] = __backend.compile(sql)
+    return stmt
+
+# cursor_type为backend的dict_cursor（结果以Dict的形式返回）或者tuple_cursor
+# 每个连接对每种cursor复用同一个，而不是每次查询都新建一个
+# cursor保存在连接对象上，与连接一起回收（cursor引用着连接，所以不能用以连接为key的WeakKeyDictionary）
+async def _cursor(connection, cursor_type):
+    cursors = getattr(connection, '_dao_cursors', None)
+    if cursors is None:
+        cursors = connection._dao_cursors = dict()
+    cur = cursors.get(cursor_type)
+    if cur is None or cur.closed:
+        cur = cursors[cursor_type] = await connection.cursor(cursor_type)
+    return cur
+
+# __pool是主库的连接池，所有写操作都在主库上执行
+# __replicas是从库，读操作（select/iterate，也就是Model.find/findByKey）轮流分配到健康的从库上，没有从库时也用主库
+__pool = None
+__replicas = []
+__next_replica = 0
+__health_task = None
+# 当前请求（asyncio的task）是否只从主库读
+__read_primary = contextvars.ContextVar('read_primary', default=False)
+# 为True时，一个请求写过数据库之后，这个请求之后的读操作都走主库，避免读不到自己刚写入的数据（主从延迟）
+__read_your_writes = True
+# 当前请求正在进行的事务（见transaction）
+__transaction = contextvars.ContextVar('transaction', default=None)
+
+class Replica(object):
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = True
+
+    def fail(self, e):
+        if self.healthy:
+            logging.warning('replica %s is unhealthy: %s' % (self.name, e))
+        self.healthy = False
+
+# 在with块中的读操作都走主库，比如载入之后要长期缓存的数据
+@contextlib.contextmanager
+def on_primary():
+    token = __read_primary.set(True)
+    try:
+        yield
+    finally:
+        __read_primary.reset(token)
+
+# 当前请求之后的读操作都走主库
+def use_primary():
+    __read_primary.set(True)
+
+def _pick_replica():
+    global __next_replica
+    if not __replicas or __read_primary.get() or __transaction.get() is not None:
+        return None
+    n = len(__replicas)
+    for i in range(n):
+        replica = __replicas[(__next_replica + i) % n]
+        if replica.healthy:
+            __next_replica = (__next_replica + i + 1) % n
+            return replica
+    return None
+
+# 定期检查不健康的从库，恢复之后重新参与分配
+async def _check_replicas(interval):
+    while True:
+        await asyncio.sleep(interval)
+        for replica in __replicas:
+            if replica.healthy:
+                continue
+            try:
+                async with replica.pool.acquire() as connection:
+                    await connection.ping()
+                replica.healthy = True
+                logging.info('replica %s is healthy again.' % replica.name)
+            except Exception as e:
+                logging.debug('replica %s is still unhealthy: %s', replica.name, e)
+
+async def close_connection():
+    global __pool, __replicas, __health_task
+    # 先把WriteBuffer中还没有写入的行写完
+    for buffer in _buffers:
+        await buffer.close()
+    if __health_task is not None:
+        __health_task.cancel()
+        __health_task = None
+    pools = [r.pool for r in __replicas]
+    if __pool is not None:
+        pools.append(__pool)
+    for pool in pools:
+        pool.close()
+        await pool.wait_closed()
+    __pool = None
+    __replicas = []
+
+# backend为'mysql'（默认）或者'sqlite'，sqlite使用path指定的数据库文件
+# replicas是从库的list，每一项是一个dict，其中没有给出的参数（比如user、db）与主库相同，只有mysql支持从库
 async def create_connection(loop, **kwargs):
     logging.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
-        loop=loop,
-        host=kwargs.get('host', 'localhost'),
-        port=kwargs.get('port', 3306),
-        user=kwargs.get('user', 'root'),
-        password=kwargs.get('password','password'),
-        db=kwargs.get('db'),
-        charset=kwargs.get('charset', 'utf8'),
-        autocommit=kwargs.get('autocommit', True),
-        maxsize=kwargs.get('maxsize', 10),
-        minsize=kwargs.get('minsize', 1)
-    )
-
-async def select(sql, args, size=None):
-    logging.info('SQL: %s' % sql)
-    global __pool
-    async with __pool.acquire() as connection:
-        # connection.cursor(aiomysql.DictCursor)使得结果以Dict的形式返回
-        cur = await connection.cursor(aiomysql.DictCursor)
-        await cur.execute(sql.replace('?', '%s'), args or ())
+    global __pool, __statements, __replicas, __health_task, __read_your_writes, __backend
+    __backend = _create_backend(kwargs.get('backend', 'mysql'))
+    __statements = dict()
+    __pool = await __backend.create_pool(loop, **kwargs)
+    __read_your_writes = kwargs.get('read_your_writes', True)
+    replicas = kwargs.get('replicas') or []
+    if replicas and __backend.name != 'mysql':
+        logging.warning('replicas are ignored by the %s backend.' % __backend.name)
+        replicas = []
+    __replicas = []
+    for r in replicas:
+        options = dict(kwargs)
+        options.update(r)
+        name = '%s:%s' % (options.get('host', 'localhost'), options.get('port', 3306))
+        logging.info('create replica connection pool %s...' % name)
+        __replicas.append(Replica(name, await __backend.create_pool(loop, **options)))
+    if __replicas:
+        __health_task = asyncio.ensure_future(_check_replicas(kwargs.get('health_interval', 5.0)), loop=loop)
+
+async def _select(pool, sql, args, size, cursor_type):
+    start = time.perf_counter()
+    async with _acquire(pool) as connection:
+        metrics.observe_pool_wait(time.perf_counter() - start)
+        cur = await _cursor(connection, cursor_type)
+        start = time.perf_counter()
+        await cur.execute(compile_sql(sql), args or ())
         if size:
             rs = await cur.fetchmany(size)
         else:
             rs = await cur.fetchall()
-        await cur.close()
+        metrics.observe_sql(sql, time.perf_counter() - start)
         return rs
 
-# 这里对于autocommit暂时没有仔细研究，等到数据库需要处理事务的时候在看看
-async def execute(sql, args, autocommit=True):
-    logging.info('SQL: %s' % sql)
+# tuples为True时每一行是一个tuple而不是dict，Model用它来构造对象，省去为每一行创建dict
+async def select(sql, args, size=None, tuples=False):
+    logging.debug('SQL: %s', sql)
     global __pool
+    cursor_type = __backend.tuple_cursor if tuples else __backend.dict_cursor
+    replica = _pick_replica()
+    if replica is None:
+        return await _select(__pool, sql, args, size, cursor_type)
+    try:
+        return await _select(replica.pool, sql, args, size, cursor_type)
+    except Exception as e:
+        # 从库连接出错时标记为不健康，这一次改从主库读；SQL本身的错误在主库上也一样，直接抛出
+        if not __backend.is_connection_error(e):
+            raise
+        replica.fail(e)
+        return await _select(__pool, sql, args, size, cursor_type)
+
+# select的流式版本，是一个async generator，逐行返回结果
+# 使用SSDictCursor（不缓冲的服务端游标），结果不会一次性全部读入内存，每次只从socket读取size行
+# 注意在迭代结束（或者aclose）之前会一直占用一个连接
+async def iterate(sql, args, size=100, tuples=False):
+    logging.debug('SQL: %s', sql)
+    global __pool
+    if __transaction.get() is not None:
+        # 事务中只有一个连接，流式查询会使这个连接在迭代结束之前不能执行其他语句，所以一次全部读出
+        for r in await select(sql, args, tuples=tuples):
+            yield r
+        return
+    replica = _pick_replica()
+    pool = __pool if replica is None else replica.pool
+    start = time.perf_counter()
+    async with pool.acquire() as connection:
+        metrics.observe_pool_wait(time.perf_counter() - start)
+        cur = await connection.cursor(__backend.stream_tuple_cursor if tuples else __backend.stream_cursor)
+        try:
+            # 流式查询只统计到服务器开始返回结果为止
+            start = time.perf_counter()
+            await cur.execute(compile_sql(sql), args or ())
+            metrics.observe_sql(sql, time.perf_counter() - start)
+            while True:
+                rs = await cur.fetchmany(size)
+                if not rs:
+                    break
+                for r in rs:
+                    yield r
+        finally:
+            await cur.close()
+
+# 当前请求写过数据库，read_your_writes时之后的读操作都走主库
+def _wrote():
+    if __read_your_writes:
+        __read_primary.set(True)
+
+# 事务：async with transaction()中的所有读写（select、execute、Model.find/save/change/remove等）
+# 都在同一个连接上执行，正常结束时commit一次，抛出异常时rollback
+# 嵌套的transaction()直接加入外层的事务，表的版本号和on_change的回调在commit之后才更新和调用
+class Transaction(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.changes = []
+        # 事务中用asyncio.gather等并发执行的语句在同一个连接上排队
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self._lock.acquire()
+        return self.connection
+
+    async def __aexit__(self, *args):
+        self._lock.release()
+
+@contextlib.asynccontextmanager
+async def transaction():
+    global __pool
+    tx = __transaction.get()
+    if tx is not None:
+        yield tx
+        return
+    _wrote()
+    start = time.perf_counter()
     async with __pool.acquire() as connection:
-        if not autocommit:
-            await connection.begin()
-        cur = await connection.cursor(aiomysql.DictCursor)
+        metrics.observe_pool_wait(time.perf_counter() - start)
+        await connection.begin()
+        tx = Transaction(connection)
+        token = __transaction.set(tx)
         try:
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            affected = cur.rowcount
-            if not autocommit:
-                await cur.commit()
+            yield tx
+            await connection.commit()
         except BaseException:
-            if not autocommit:
-                await cur.rollback()
+            await connection.rollback()
+            raise
+        finally:
+            __transaction.reset(token)
+    for model, action in tx.changes:
+        notify_change(model, action)
+
+def in_transaction():
+    return __transaction.get() is not None
+
+# 在事务中时使用事务的连接，否则从pool中取一个
+def _acquire(pool):
+    tx = __transaction.get()
+    if tx is not None:
+        return tx
+    return pool.acquire()
+
+# autocommit=False时这一条语句在一个单独的事务中执行，已经在事务中时加入那个事务
+async def execute(sql, args, autocommit=True):
+    if not autocommit and __transaction.get() is None:
+        async with transaction():
+            return await execute(sql, args)
+    logging.debug('SQL: %s', sql)
+    global __pool
+    _wrote()
+    start = time.perf_counter()
+    async with _acquire(__pool) as connection:
+        metrics.observe_pool_wait(time.perf_counter() - start)
+        cur = await _cursor(connection, __backend.dict_cursor)
+        start = time.perf_counter()
+        await cur.execute(compile_sql(sql), args or ())
+        metrics.observe_sql(sql, time.perf_counter() - start)
+        return cur.rowcount
+
+# 用一条语句批量写入，在同一个事务中完成，要么全部成功要么全部回滚
+# 对于insert ... values，aiomysql的executemany会把多组参数拼成一条多行insert，只需要一次往返
+async def execute_many(sql, args_list):
+    if __transaction.get() is None:
+        async with transaction():
+            return await execute_many(sql, args_list)
+    logging.debug('SQL: %s', sql)
+    _wrote()
+    async with _acquire(None) as connection:
+        cur = await _cursor(connection, __backend.dict_cursor)
+        start = time.perf_counter()
+        await cur.executemany(compile_sql(sql), args_list)
+        metrics.observe_sql(sql, time.perf_counter() - start)
+        return cur.rowcount
+
+# 写缓冲（group commit）：把很多请求同时进行的insert合并成一条多行insert，在一个事务中写入
+# 第一行进入缓冲delay秒之后，或者攒够max_rows行时写一次，这样高峰期的n个insert只占用一个连接、一次往返
+# save在这一批写入完成之后才返回，写入失败时抛出与Model.save相同的异常
+_buffers = []
+
+class WriteBuffer(object):
+    # on_write(models)在写入这一批的同一个事务中调用，用于需要与这些行一起提交的写操作（比如汇总表），
+    # 这样一批只占用一个连接、一个事务
+    def __init__(self, model, delay=0.005, max_rows=100, on_write=None):
+        self.model = model
+        self.delay = delay
+        self.max_rows = max_rows
+        self.on_write = on_write
+        self._rows = []          # [(Model, insert的参数, future)]
+        self._timer = None
+        self._tasks = set()
+        _buffers.append(self)
+
+    async def save(self, m):
+        if not isinstance(m, self.model):
+            raise ValueError('Expect %s but got %s' % (self.model.__name__, type(m).__name__))
+        # 事务中的写入必须在事务的连接上完成，不能推迟到事务之外
+        if in_transaction():
+            await m.save()
+            if self.on_write is not None:
+                await self.on_write([m])
+            return
+        args = [getattr(m, k) for k in self.model.__fields__]
+        args.append(getattr(m, self.model.__primary_key__))
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._rows.append((m, args, future))
+        # 真正的写入在另一个task中进行，read_your_writes要在调用者自己的context中设置
+        _wrote()
+        if len(self._rows) >= self.max_rows:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.delay, self.flush)
+        await future
+
+    # 把当前缓冲中的行交给一个新的task写入，不等待写入完成
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._rows:
+            return
+        batch, self._rows = self._rows, []
+        task = asyncio.ensure_future(self._write(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # 在一个事务中写入batch并调用on_write，要么全部成功要么全部回滚
+    async def _insert(self, batch):
+        async with transaction():
+            rows = await execute_many(self.model.__insert__, [args for m, args, future in batch])
+            if self.on_write is not None:
+                await self.on_write([m for m, args, future in batch])
+        return rows
+
+    async def _write(self, batch):
+        try:
+            rows = await self._insert(batch)
+        except Exception as e:
+            # 一批中只要有一行出错（比如主键重复）整个事务就会回滚，这时逐行重新写入，每个调用者得到自己的结果
+            logging.warning('group commit of %d rows failed, retry one by one: %s' % (len(batch), e))
+            for item in batch:
+                m, args, future = item
+                try:
+                    await self._insert([item])
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                self._done(m, future)
+            return
+        if rows != len(batch):
+            logging.error('failed to insert records: affected rows: %s of %s' % (rows, len(batch)))
+        for m, args, future in batch:
+            self._done(m, future)
+
+    def _done(self, m, future):
+        notify_change(m, 'save')
+        # 调用者的请求可能已经被取消，但是数据已经写入了
+        if not future.done():
+            future.set_result(None)
+
+    # 写入缓冲中剩下的行，并等待所有正在进行的写入完成
+    async def close(self):
+        self.flush()
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+# 每张表的版本号，Model每次save/change/remove都会使其+1，缓存可以据此判断是否失效
+# 只记录本进程内通过Model完成的写操作
+_versions = dict()
+# 每张表最后一次修改的时间，没有修改过的表为进程启动的时间
+_modified = dict()
+_started = time.time()
+# 每张表上注册的回调函数，写操作完成后以fn(action, model)的形式调用
+_listeners = dict()
+
+def table_version(table):
+    return _versions.get(table, 0)
+
+def table_modified(table):
+    return _modified.get(table, _started)
+
+# 其他进程（比如import_foods.py）直接修改了数据库之后，让这些表的缓存和ETag失效
+# 只更新版本号，没有具体的行，所以不调用on_change的回调，依赖版本号的缓存会在下一次读取时重新载入
+def invalidate(*tables):
+    now = time.time()
+    for table in tables:
+        _versions[table] = _versions.get(table, 0) + 1
+        _modified[table] = now
+
+def on_change(table, fn):
+    _listeners.setdefault(table, []).append(fn)
+
+def notify_change(model, action):
+    # 事务中的修改在commit之后才生效，这时再通知，避免缓存读到旧的数据却记下了新的版本号
+    tx = __transaction.get()
+    if tx is not None:
+        tx.changes.append((model, action))
+        return
+    table = model.__table__
+    _versions[table] = _versions.get(table, 0) + 1
+    _modified[table] = time.time()
+    for fn in _listeners.get(table, ()):
+        fn(action, model)
+
+# 根据Model的定义建表和__indexes__中的索引，已经存在的表和索引不受影响
+async def create_tables(*models):
+    for model in models:
+        await execute(model.__create__, [])
+        for columns in model.__indexes__:
+            await create_index(model.__table__, columns)
+
+async def _index_exists(table, name):
+    with on_primary():
+        return bool(await select(__backend.index_exists_sql, [table, name]))
+
+# 索引名为idx_<表名>_<列名>，SQLite的索引名在整个数据库中不能重复，所以带上表名
+async def create_index(table, columns):
+    name = 'idx_%s_%s' % (table, '_'.join(columns))
+    if await _index_exists(table, name):
+        return
+    try:
+        await execute('create index `%s` on `%s` (%s)' % (name, table, ', '.join('`%s`' % c for c in columns)), [])
+    except Exception:
+        # 多个worker同时启动时可能被别的进程抢先建好了
+        if not await _index_exists(table, name):
             raise
-        return affected
+    logging.info('created index %s.' % name)
+
+# keyset分页用的游标，把上一页最后一行的排序列的值编码成对客户端不透明的字符串
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw.decode('utf-8'))
+    except Exception:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    if not isinstance(values, list) or not values:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    # 游标来自客户端，其中的值会直接作为SQL的参数，只接受字符串和数字
+    for v in values:
+        if isinstance(v, bool) or not isinstance(v, (str, int, float)):
+            raise ValueError('Invalid cursor: %s' % cursor)
+    return values
 
 # 用来生成id，取代数据库中自增的id号
 def generate_uid():
@@ -86,6 +565,30 @@ class TextField(Field):
         super().__init__(column_name, column_type, primary_key, default)
 
 
+# 为每个Model生成按列展开的from_row、dict_from_row和to_dict，代替Model中逐列循环的版本（与collections.namedtuple的做法相同）
+# 列名都是合法的标识符（否则不能作为slot），可以直接拼进代码
+def _row_functions(columns, getters):
+    env = {'get_%s' % c: getters[c] for c in columns}
+    source = ('def from_row(cls, row):\n'
+              '    m = cls.__new__(cls)\n'
+              '    %s, = row\n'
+              '    return m\n'
+              'def dict_from_row(cls, row):\n'
+              '    %s, = row\n'
+              '    return {%s}\n'
+              'def to_dict(self):\n'
+              '    try:\n'
+              '        return {%s}\n'
+              '    except AttributeError:\n'
+              '        return dict(self.items())\n') % (
+        ', '.join('m.%s' % c for c in columns),
+        ', '.join(columns),
+        ', '.join("'%s': %s" % (c, c) for c in columns),
+        ', '.join("'%s': get_%s(self)" % (c, c) for c in columns))
+    exec(source, env)
+    return env['from_row'], env['dict_from_row'], env['to_dict']
+
+
 class ModelMetaclass(type):
     def __new__(cls, name, bases, attrs):
         if name=='Model':
@@ -114,38 +617,133 @@ class ModelMetaclass(type):
         # SQL中列名由``包围，比如`user_id`
         sql_fields = list(map(lambda f: '`%s`' % f, fields))
         attrs['__mappings__'] = mappings # 保存属性和列的映射关系
-        attrs['__table__'] = name # 假设表名和类名一致
+        attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey  # 主键属性名
         attrs['__fields__'] = fields  # 除主键外的属性名
         attrs['__select__'] = 'select `%s`, %s from `%s`' % \
                               (primaryKey, ', '.join(sql_fields), tableName)
+        # 以下几个完整的语句使用'%s'占位符，compile_sql对MySQL不做改变，SQLite会转换为'?'
+        attrs['__select_key__'] = '%s where `%s`=%%s' % (attrs['__select__'], primaryKey)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % \
-                              (tableName, ', '.join(sql_fields), primaryKey, ('%s?') % ('?, '*len(sql_fields)))
-        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % \
-                              (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).column_name or f), fields)), primaryKey)
-        attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+                              (tableName, ', '.join(sql_fields), primaryKey, ', '.join(['%s'] * (len(sql_fields) + 1)))
+        attrs['__update__'] = 'update `%s` set %s where `%s`=%%s' % \
+                              (tableName, ', '.join(map(lambda f: '`%s`=%%s' % (mappings.get(f).column_name or f), fields)), primaryKey)
+        attrs['__delete__'] = 'delete from `%s` where `%s`=%%s' % (tableName, primaryKey)
+        # 需要的索引，每一项是列名的tuple，由create_tables创建
+        attrs['__indexes__'] = tuple(tuple(columns) for columns in attrs.get('__indexes__', ()))
+        attrs['__create__'] = 'create table if not exists `%s` (`%s` %s primary key, %s)' % \
+                              (tableName, primaryKey, mappings[primaryKey].column_type,
+                               ', '.join('`%s` %s' % (f, mappings[f].column_type) for f in fields))
+        # 每一列是一个slot，对象没有__dict__，与__select__中列的顺序相同，tuple形式的结果可以按位置直接填入
+        columns = (primaryKey,) + tuple(fields)
+        attrs['__columns__'] = columns
+        attrs['__slots__'] = columns
+        model = type.__new__(cls, name, bases, attrs)
+        # slot的描述符，没有赋值的slot读取时抛AttributeError，不会触发__getattr__中的默认值
+        model.__getters__ = {c: model.__dict__[c].__get__ for c in columns}
+        from_row, dict_from_row, to_dict = _row_functions(columns, model.__getters__)
+        model.from_row = classmethod(from_row)
+        model.dict_from_row = classmethod(dict_from_row)
+        model.to_dict = to_dict
+        return model
+
 
+# Model的每一列保存在slot中，比dict小得多，属性访问也更快
+# 同时保留dict风格的接口（m['key']、get、keys、items、values、in、**m），没有赋值的列不出现在keys中
+class Model(object, metaclass=ModelMetaclass):
+    __slots__ = ()
 
-class Model(dict, metaclass=ModelMetaclass):
     def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
+        for k, v in kw.items():
+            setattr(self, k, v)
 
+    # 由tuple形式的结果构造，row中列的顺序与__columns__相同，ModelMetaclass会替换为按列展开的版本
+    @classmethod
+    def from_row(cls, row):
+        m = cls.__new__(cls)
+        for k, v in zip(cls.__columns__, row):
+            setattr(m, k, v)
+        return m
+
+    # 由tuple形式的结果直接构造dict，不经过Model对象，ModelMetaclass会替换为按列展开的版本
+    @classmethod
+    def dict_from_row(cls, row):
+        return dict(zip(cls.__columns__, row))
+
+    # 只有没有赋值的列才会进入__getattr__
     def __getattr__(self, key):
-        try:
-            return self[key]
-        except KeyError:
-            field = self.__mappings__[key]
-            if field.default is not None:
-                logging.info(r"Use default value for '{0}'".format(key))
-                return field.default
-            logging.info(r"'Model' object has no attribute '{0}'".format(key))
+        field = self.__mappings__.get(key)
+        if field is None:
+            raise AttributeError(r"'{0}' object has no attribute '{1}'".format(type(self).__name__, key))
+        if field.default is None:
             return None
+        # default可以是函数（比如dao.generate_uid），每个对象调用一次，并保存下来使之后取到的值不变
+        value = field.default() if callable(field.default) else field.default
+        setattr(self, key, value)
+        return value
+
+    def __getitem__(self, key):
+        if key not in self.__mappings__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__mappings__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        get_value = self.__getters__.get(key)
+        if get_value is None:
+            return False
+        try:
+            get_value(self)
+        except AttributeError:
+            return False
+        return True
 
-    def __setattr__(self, key, value):
-        self[key] = value
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        items = []
+        for k, get_value in self.__getters__.items():
+            try:
+                items.append((k, get_value(self)))
+            except AttributeError:
+                pass
+        return items
+
+    def keys(self):
+        return [k for k, v in self.items()]
+
+    def values(self):
+        return [v for k, v in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    # 只包含已赋值的列，用于JSON序列化，ModelMetaclass会替换为按列展开的版本
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Model):
+            return type(self) is type(other) and self.items() == other.items()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % kv for kv in self.items()))
 
     # find和findByKey都是返回Model类型的方法，所以要用classmethod，而其他CRD操作只是返回操作结果，所以非classmethod
+    # as_dicts=True时返回dict而不是Model，用于只输出JSON的查询：省去构造Model，序列化时也不需要再转换
     @classmethod
     async def find(cls, where=None, args=None, **kw):
         #find objects by where clause.
@@ -170,34 +768,105 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        rs = await select(' '.join(sql), args, tuples=True)
+        return list(map(cls.dict_from_row if kw.get('as_dicts') else cls.from_row, rs))
+
+    # find的流式版本，逐个yield Model对象，用于结果很大的查询
+    @classmethod
+    async def stream(cls, where=None, args=None, orderBy=None, as_dicts=False):
+        sql = [cls.__select__]
+        if where:
+            sql.append('where')
+            sql.append(where)
+        if orderBy:
+            sql.append('order by')
+            sql.append(orderBy)
+        from_row = cls.dict_from_row if as_dicts else cls.from_row
+        async for r in iterate(' '.join(sql), args, tuples=True):
+            yield from_row(r)
+
+    # keyset分页：按(orderBy, 主键)排序，用上一页最后一行的值作为下一页的起点，
+    # 不像limit offset那样越往后翻越慢。返回(本页的结果, 下一页的游标)，没有下一页时游标为None
+    @classmethod
+    async def findPage(cls, where=None, args=None, after=None, size=20, orderBy=None, desc=False, as_dicts=False):
+        pk = cls.__primary_key__
+        if orderBy is not None and orderBy not in cls.__fields__:
+            raise ValueError('Invalid order column: %s' % orderBy)
+        args = list(args or [])
+        conds = []
+        if where:
+            conds.append('(%s)' % where)
+        op = '<' if desc else '>'
+        if after:
+            values = decode_cursor(after)
+            if orderBy:
+                if len(values) != 2:
+                    raise ValueError('Invalid cursor: %s' % after)
+                conds.append('(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (orderBy, op, orderBy, pk, op))
+                args.extend([values[0], values[0], values[1]])
+            else:
+                conds.append('`%s` %s ?' % (pk, op))
+                args.append(values[0])
+        direction = ' desc' if desc else ''
+        order = '`%s`%s' % (pk, direction)
+        if orderBy:
+            order = '`%s`%s, %s' % (orderBy, direction, order)
+        # 多取一行用来判断是否还有下一页
+        rs = await cls.find(' and '.join(conds) or None, args, orderBy=order, limit=size + 1, as_dicts=as_dicts)
+        cursor = None
+        if len(rs) > size:
+            rs = rs[:size]
+            last = rs[-1]
+            cursor = encode_cursor([last[orderBy], last[pk]] if orderBy else [last[pk]])
+        return rs, cursor
 
     @classmethod
     async def findByKey(cls, pk):
         ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        rs = await select(cls.__select_key__, [pk], 1, tuples=True)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return cls.from_row(rs[0])
 
     async def save(self):
-        args = list(map(self.__getattr__, self.__fields__))
-        args.append(self.__getattr__(self.__primary_key__))
+        args = [getattr(self, k) for k in self.__fields__]
+        args.append(getattr(self, self.__primary_key__))
         rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.error('failed to insert record: affected rows: %s' % rows)
+        notify_change(self, 'save')
+
+    # 批量insert，models必须都是cls的实例，返回写入的行数
+    @classmethod
+    async def save_many(cls, models):
+        if not models:
+            return 0
+        args_list = []
+        for m in models:
+            if not isinstance(m, cls):
+                raise ValueError('Expect %s but got %s' % (cls.__name__, type(m).__name__))
+            args = [getattr(m, k) for k in cls.__fields__]
+            args.append(getattr(m, cls.__primary_key__))
+            args_list.append(args)
+        rows = await execute_many(cls.__insert__, args_list)
+        if rows != len(models):
+            logging.error('failed to insert records: affected rows: %s of %s' % (rows, len(models)))
+        for m in models:
+            notify_change(m, 'save')
+        return rows
 
     async def change(self):
-        args = list(map(self.__getattr__, self.__fields__))
-        args.append(self.__getattr__(self.__primary_key__))
+        args = [getattr(self, k) for k in self.__fields__]
+        args.append(getattr(self, self.__primary_key__))
         rows = await execute(self.__update__, args)
         if rows != 1:
             logging.error('failed to update by primary key: affected rows: %s' % rows)
+        notify_change(self, 'change')
 
     async def remove(self):
-        args = [self.__getattr__(self.__primary_key__)]
+        args = [getattr(self, self.__primary_key__)]
         rows = await execute(self.__delete__, args)
         if rows != 1:
             logging.error('failed to remove by primary key: affected rows: %s' % rows)
+        notify_change(self, 'remove')
 
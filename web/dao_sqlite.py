@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# dao的SQLite后端，基于aiosqlite，适合单机部署以及没有MySQL的测试和benchmark
+# 这里把aiosqlite包装成和aiomysql的连接池一样的接口（pool.acquire()、connection.cursor()、cursor.execute()等），
+# 所以dao中的select/execute不需要区分后端
+
+import asyncio
+import aiosqlite
+
+# 结果以dict的形式返回，与aiomysql.DictCursor一致
+def _dict_factory(cursor, row):
+    return {d[0]: v for d, v in zip(cursor.description, row)}
+
+class Cursor(object):
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.closed = False
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    async def execute(self, sql, args=()):
+        await self._cursor.execute(sql, args)
+
+    async def executemany(self, sql, args_list):
+        await self._cursor.executemany(sql, args_list)
+
+    async def fetchall(self):
+        return await self._cursor.fetchall()
+
+    async def fetchmany(self, size):
+        return await self._cursor.fetchmany(size)
+
+    async def close(self):
+        self.closed = True
+        await self._cursor.close()
+
+class Connection(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    # cursor的类型就是sqlite3的row_factory：_dict_factory返回dict，None返回tuple，fetchmany本身就是逐批读取的
+    async def cursor(self, row_factory=_dict_factory):
+        cursor = await self._conn.cursor()
+        cursor.row_factory = row_factory
+        return Cursor(cursor)
+
+    # 事务一开始就取得写锁：deferred的事务先读后写时，如果别的连接已经写入，会直接失败而不会等待busy_timeout
+    async def begin(self):
+        await self._conn.execute('begin immediate')
+
+    async def commit(self):
+        await self._conn.commit()
+
+    async def rollback(self):
+        await self._conn.rollback()
+
+    async def ping(self):
+        await self._conn.execute('select 1')
+
+    async def close(self):
+        await self._conn.close()
+
+class _Acquire(object):
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._pool._free.get()
+        return self._conn
+
+    async def __aexit__(self, *args):
+        self._pool._free.put_nowait(self._conn)
+
+# 固定大小的连接池，WAL模式下多个连接可以同时读，写操作由SQLite排队（busy_timeout）
+class Pool(object):
+    def __init__(self, connections):
+        self._connections = connections
+        self._free = asyncio.Queue()
+        for c in connections:
+            self._free.put_nowait(c)
+
+    def acquire(self):
+        return _Acquire(self)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        for c in self._connections:
+            await c.close()
+
+class SQLiteBackend(object):
+    name = 'sqlite'
+
+    def __init__(self):
+        self.dict_cursor = self.stream_cursor = _dict_factory
+        self.tuple_cursor = self.stream_tuple_cursor = None
+
+    async def create_pool(self, loop, **kwargs):
+        path = kwargs.get('path') or 'diet_pal.db'
+        connections = []
+        for i in range(kwargs.get('maxsize', 4)):
+            # isolation_level=None：与aiomysql的autocommit=True相同，需要事务时显式begin
+            conn = await aiosqlite.connect(path, isolation_level=None)
+            conn.row_factory = _dict_factory
+            await conn.execute('pragma journal_mode=wal')
+            await conn.execute('pragma synchronous=normal')
+            await conn.execute('pragma busy_timeout=5000')
+            connections.append(Connection(conn))
+        return Pool(connections)
+
+    # ModelMetaclass生成的语句使用'%s'，其他地方使用'?'，SQLite只认'?'
+    def compile(self, sql):
+        return sql.replace('%s', '?')
+
+    # SQLite没有从库，这个只是与MySQLBackend保持相同的接口
+    def is_connection_error(self, e):
+        return isinstance(e, (OSError, asyncio.TimeoutError))
+
+    index_exists_sql = "select 1 from sqlite_master where type='index' and tbl_name=? and name=?"
+
+    def upsert_sql(self, table, pk, columns, increments=(), updates=()):
+        sets = ['`%s`=`%s`+excluded.`%s`' % (c, c, c) for c in increments]
+        sets.extend('`%s`=excluded.`%s`' % (c, c) for c in updates)
+        return 'insert into `%s` (%s) values (%s) on conflict(`%s`) do update set %s' % (
+            table, ', '.join('`%s`' % c for c in columns), ', '.join('?' for c in columns), pk, ', '.join(sets))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 批量导入食物数据（比如公开的营养成分数据库）到food表
+# 逐行读取CSV、JSON Lines或者JSON数组文件，按Food的字段检查每一行，每chunk行用一条多行的
+# insert ... on duplicate key update（SQLite为on conflict do update）写入，food_id已经存在的行会被更新
+# 只写入文件中给出的列，没有给出的列在已经存在的行中保持原值
+# 任何时候内存中只有一个chunk，所以文件再大也不会占用更多内存
+# 运行中的服务器缓存了食物数据，导入之后要对app.py的进程发送SIGHUP（kill -HUP <pid>）才能看到新的数据：
+# 单进程时清空缓存，多进程时由supervisor逐个重启worker
+# 命令行用法: python3 import_foods.py foods.csv [--format csv|jsonl|json] [--chunk 1000] [--dry-run]
+
+import os, io, re, csv, sys, json, time, asyncio, logging, argparse
+import dao
+from dao import IntegerField, FloatField
+from configs import configs
+from model import Food
+
+PROGRESS_INTERVAL = 2.0
+READ_SIZE = 64 * 1024
+
+class RowError(ValueError):
+    pass
+
+# 根据Food的定义生成每一列的转换函数
+def _converter(name, field):
+    if isinstance(field, IntegerField):
+        def convert(v):
+            if isinstance(v, float) and v.is_integer():
+                return int(v)
+            if isinstance(v, (bool, float)):
+                raise RowError('%s must be an integer: %r' % (name, v))
+            return int(v)
+    elif isinstance(field, FloatField):
+        def convert(v):
+            if isinstance(v, bool):
+                raise RowError('%s must be a number: %r' % (name, v))
+            return float(v)
+    else:
+        m = re.match(r'varchar\((\d+)\)', field.column_type, re.I)
+        size = int(m.group(1)) if m else None
+        def convert(v):
+            v = str(v).strip()
+            if size is not None and len(v) > size:
+                raise RowError('%s is longer than %d characters' % (name, size))
+            return v
+    return convert
+
+CONVERTERS = {name: _converter(name, field) for name, field in Food.__mappings__.items()}
+
+# 把一行（dict）转换为(列名的tuple, upsert的参数)，只包含row中有的列，顺序与Food.__columns__相同
+# 给出了但是值为空（CSV中的空字符串、JSON中的null）的列设为NULL
+def validate(row):
+    pk = Food.__primary_key__
+    columns = []
+    args = []
+    for name in Food.__columns__:
+        if name not in row:
+            if name == pk:
+                raise RowError('missing %s' % name)
+            continue
+        v = row[name]
+        if v is None or v == '':
+            if name == pk:
+                raise RowError('missing %s' % name)
+            v = None
+        else:
+            try:
+                v = CONVERTERS[name](v)
+            except RowError:
+                raise
+            except (TypeError, ValueError):
+                raise RowError('invalid %s: %r' % (name, v))
+        columns.append(name)
+        args.append(v)
+    if len(columns) == 1:
+        raise RowError('no columns besides %s' % pk)
+    return tuple(columns), args
+
+# 每一种列的组合对应一条upsert语句，通常整个文件只有一种
+_statements = dict()
+
+def upsert_sql(columns):
+    sql = _statements.get(columns)
+    if sql is None:
+        pk = Food.__primary_key__
+        sql = _statements[columns] = dao.upsert_sql(Food.__table__, pk, columns,
+                                                    updates=[c for c in columns if c != pk])
+    return sql
+
+# 读取函数逐个yield一行（dict），不能解析的行yield一个RowError，计入错误之后继续读下一行
+# CSV中比表头短的行，缺少的列为None，当作没有给出这些列
+def read_csv(f):
+    for row in csv.DictReader(f):
+        yield {k.strip(): v for k, v in row.items() if k and v is not None}
+
+def read_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield RowError('invalid JSON: %s' % e)
+
+_TOKEN_RE = re.compile(r'[",{}\[\]]')
+_STRING_RE = re.compile(r'(?:[^"\\]|\\.)*"', re.S)
+
+# 跳过JSON数组中从pos开始的一个不合法的值，返回它后面的','或者数组结束的']'的位置，
+# buf中的数据还不完整（没有找到）时返回None
+def _skip_value(buf, pos):
+    depth = 0
+    while True:
+        m = _TOKEN_RE.search(buf, pos)
+        if m is None:
+            return None
+        ch = m.group()
+        pos = m.end()
+        if ch == '"':
+            m = _STRING_RE.match(buf, pos)
+            if m is None:
+                return None
+            pos = m.end()
+        elif ch in '{[':
+            depth += 1
+        elif depth == 0 and ch in ',]':
+            return m.start()
+        elif ch in '}]':
+            depth = max(depth - 1, 0)
+
+# 逐个解析JSON数组中的对象，不把整个文件读入内存
+def read_json(f):
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    while True:
+        # 跳过空白、'['和','，之后应该是一个完整的对象
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf):
+                break
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                return
+            buf, pos = buf[pos:] + chunk, 0
+        if not started:
+            if buf[pos] != '[':
+                raise ValueError('JSON file must contain an array of objects')
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == ']':
+            return
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                break
+            except ValueError as e:
+                error = RowError('invalid JSON: %s' % e)
+            # 能找到这个值的结束位置说明它本身不合法，跳过它；否则是对象被chunk截断了，再读一些
+            end = _skip_value(buf, pos)
+            if end is not None:
+                obj = error
+                break
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                yield error
+                return
+            buf, pos = buf[pos:] + chunk, 0
+        yield obj
+        pos = end
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl, 'json': read_json}
+
+def guess_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    if ext == '.json':
+        return 'json'
+    return 'csv'
+
+class Progress(object):
+    def __init__(self, raw, total):
+        self.raw = raw
+        self.total = total
+        self.start = self.last = time.time()
+        self.rows = self.imported = self.errors = 0
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        percent = self.raw.tell() * 100.0 / self.total if self.total else 100.0
+        elapsed = now - self.start
+        logging.info('%5.1f%%  %d rows, %d imported, %d errors, %.0f rows/s' % (
+            percent, self.rows, self.imported, self.errors, self.rows / elapsed if elapsed else 0))
+
+async def import_foods(path, format=None, chunk=1000, dry_run=False):
+    with open(path, 'rb') as raw:
+        f = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+        progress = Progress(raw, os.path.getsize(path))
+        # 列的组合 -> 还没有写入的行，不同组合的行用不同的语句写入
+        batches = dict()
+
+        async def write(columns):
+            batch = batches.pop(columns)
+            if not dry_run:
+                await dao.execute_many(upsert_sql(columns), batch)
+            progress.imported += len(batch)
+
+        for i, row in enumerate(READERS[format or guess_format(path)](f), 1):
+            progress.rows += 1
+            try:
+                if isinstance(row, RowError):
+                    raise row
+                if not isinstance(row, dict):
+                    raise RowError('row must be an object')
+                columns, args = validate(row)
+            except RowError as e:
+                progress.errors += 1
+                logging.warning('row %d: %s' % (i, e))
+                continue
+            batch = batches.setdefault(columns, [])
+            batch.append(args)
+            if len(batch) >= chunk:
+                await write(columns)
+                progress.report()
+        for columns in list(batches):
+            await write(columns)
+        progress.report(force=True)
+    return progress.imported, progress.errors
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Import foods from a CSV, JSON Lines or JSON file.')
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=sorted(READERS), help='default: guessed from the file extension')
+    parser.add_argument('--chunk', type=int, default=1000, help='rows per insert statement')
+    parser.add_argument('--dry-run', action='store_true', help='only validate the file')
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(dao.create_connection(loop, db='diet_pal', backend=configs.db.backend, path=configs.db.path))
+    if configs.db.backend == 'sqlite':
+        loop.run_until_complete(dao.create_tables(Food))
+    imported, errors = loop.run_until_complete(import_foods(args.path, args.format, args.chunk, args.dry_run))
+    loop.run_until_complete(dao.close_connection())
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 延迟统计：SQL、连接池等待、URL处理函数、模板渲染的耗时直方图，以Prometheus的文本格式从/metrics输出
+# 每次记录只是一次二分查找加上几个数的累加，开销可以忽略
+# 超过configs.metrics.slow_query秒的SQL会写一条warning日志
+
+import bisect, logging, contextvars
+from configs import configs
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+class Histogram(object):
+    def __init__(self, name, doc, label_names=(), buckets=BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.label_names = label_names
+        self.buckets = buckets
+        # labels的tuple -> [每个bucket的计数（最后一个是+Inf）, 总和]
+        self.series = dict()
+
+    def observe(self, labels, value):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect.bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.doc))
+        lines.append('# TYPE %s histogram' % self.name)
+        for labels, (counts, total) in self.series.items():
+            base = ','.join('%s="%s"' % (k, _escape(v)) for k, v in zip(self.label_names, labels))
+            prefix = base + ',' if base else ''
+            n = 0
+            for le, c in zip(self.buckets + ('+Inf',), counts):
+                n += c
+                lines.append('%s_bucket{%sle="%s"} %d' % (self.name, prefix, le, n))
+            suffix = '{%s}' % base if base else ''
+            lines.append('%s_sum%s %.6f' % (self.name, suffix, total))
+            lines.append('%s_count%s %d' % (self.name, suffix, n))
+
+sql_seconds = Histogram('dietpal_sql_seconds', 'SQL execution time by statement.', ('sql',))
+pool_wait_seconds = Histogram('dietpal_pool_wait_seconds', 'Time spent waiting for a database connection.')
+request_seconds = Histogram('dietpal_request_seconds', 'URL handler time by route.', ('method', 'route'))
+template_seconds = Histogram('dietpal_template_seconds', 'Jinja2 rendering time by template.', ('template',))
+# 以下两个只在开启了profiler（configs.profile.enabled）时才有数据
+request_dao_seconds = Histogram('dietpal_request_dao_seconds', 'Time a request spent awaiting dao by route.', ('method', 'route'))
+loop_lag_seconds = Histogram('dietpal_loop_lag_seconds', 'Event loop lag.')
+
+HISTOGRAMS = [request_seconds, request_dao_seconds, template_seconds, sql_seconds, pool_wait_seconds, loop_lag_seconds]
+
+SLOW_QUERY = configs.metrics.slow_query
+
+# 当前请求等待dao（连接池和SQL）的累计时间，是一个只有一个元素的list，由profiler的middleware设置
+# 没有设置时（没有开启profiler）为None
+dao_seconds = contextvars.ContextVar('dao_seconds', default=None)
+
+# sql是带'?'占位符的原始语句，不同参数的同一种查询算作一类
+def observe_sql(sql, seconds):
+    sql_seconds.observe((sql,), seconds)
+    if seconds >= SLOW_QUERY:
+        logging.warning('slow query (%.3fs): %s' % (seconds, sql))
+    total = dao_seconds.get()
+    if total is not None:
+        total[0] += seconds
+
+def observe_pool_wait(seconds):
+    pool_wait_seconds.observe((), seconds)
+    total = dao_seconds.get()
+    if total is not None:
+        total[0] += seconds
+
+def render():
+    lines = []
+    for h in HISTOGRAMS:
+        h.render(lines)
+    lines.append('')
+    return '\n'.join(lines)
@@ -2,8 +2,72 @@
 # -*- coding: utf-8 -*-
 
 from aiohttp import web
-import json
+import time
 from configs import configs
+import metrics
+from serializer import dumps
+from dao import Model
+import compress
+
+# 流式输出时每攒够这么多行写一次，避免每一行都产生一个chunk
+STREAM_BATCH = 100
+
+# 与Python查找特殊方法一样在类型上检查，不触发实例的__getattr__
+def _is_stream(v):
+    return hasattr(type(v), '__aiter__')
+
+# 当返回的dict中有async iterator（比如Model.stream()）时，使用chunked的StreamResponse，
+# 一边迭代一边序列化写出，不管结果有多大，内存中只保留一批数据
+async def stream_json(request, r):
+    resp = web.StreamResponse()
+    resp.content_type = 'application/json'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    # 流式输出不经过compress_factory，客户端接受gzip时由aiohttp边写边压缩
+    compress.add_vary(resp, 'Accept-Encoding')
+    if compress.negotiate(request.headers.get('Accept-Encoding'), ('gzip',)):
+        resp.enable_compression(web.ContentCoding.gzip)
+    await resp.prepare(request)
+    try:
+        await resp.write(b'{')
+        for i, (k, v) in enumerate(r.items()):
+            if i > 0:
+                await resp.write(b',')
+            await resp.write(dumps(k) + b':')
+            if not _is_stream(v):
+                await resp.write(dumps(v))
+                continue
+            # 每一批用一次dumps编码成数组，去掉两边的括号再拼起来
+            await resp.write(b'[')
+            batch = []
+            first = True
+            async for row in v:
+                batch.append(row)
+                if len(batch) >= STREAM_BATCH:
+                    await resp.write((b'' if first else b',') + dumps(batch)[1:-1])
+                    batch = []
+                    first = False
+            if batch:
+                await resp.write((b'' if first else b',') + dumps(batch)[1:-1])
+            await resp.write(b']')
+        await resp.write(b'}')
+        await resp.write_eof()
+    finally:
+        # 客户端中途断开时也要关闭generator，归还数据库连接
+        for v in r.values():
+            if hasattr(type(v), 'aclose'):
+                await v.aclose()
+    return resp
+
+# 条件GET的路由（webframe.conditional）加上ETag、Last-Modified和Cache-Control
+def _cache_headers(request, resp):
+    cache = getattr(request, '__cache__', None)
+    if cache is not None:
+        etag, last_modified, cache_control = cache
+        resp.headers['ETag'] = etag
+        resp.headers['Last-Modified'] = last_modified
+        resp.headers['Cache-Control'] = cache_control
+    return resp
 
 # 函数返回值转化为web.response对象（必要的一个middleware）
 # 当服务器接收到请求，先调用此中间件，其中调用RequestHandler并执行相应controller，然后中间件对结果封装成response
@@ -22,17 +86,23 @@ async def response_factory(app, handler):
             resp =  web.Response(body=r.encode('utf-8'))
             resp.content_type = 'text/html;charsest=utf-8'
             return resp
-        if isinstance(r,dict):
+        # URL处理函数也可以直接返回一个Model对象
+        if isinstance(r, (dict, Model)):
             template = r.get('__template__')
             if template is None: # 序列化JSON，传递数据
-                # https://docs.python.org/2/library/json.html#basic-usage
-                resp = web.Response(body=json.dumps(
-                    r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
-                return resp
+                if any(_is_stream(v) for v in r.values()):
+                    return await stream_json(request, r)
+                resp = web.Response(body=dumps(r))
+                resp.content_type = 'application/json'
+                resp.charset = 'utf-8'
+                return _cache_headers(request, resp)
             else: #jinja2模板
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                start = time.perf_counter()
+                body = app['__templating__'].get_template(template).render(**r).encode('utf-8')
+                metrics.template_seconds.observe((template,), time.perf_counter() - start)
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html;charset=utf-8'
-                return resp
+                return _cache_headers(request, resp)
         if isinstance(r, int) and r >= 100 and r < 600:
             return web.Response(r)
         if isinstance(r, tuple) and len(r) == 2:
@@ -5,7 +5,7 @@ from dao import Model, IntegerField, StringField, FloatField, TextField
 class User(Model):
     __table__ = 'user'
 
-    user_id = IntegerField(primary_key=True, column_type='varchar(50)', default=dao.generate_uid())
+    user_id = IntegerField(primary_key=True, column_type='varchar(50)', default=dao.generate_uid)
     username = StringField(column_type='varchar(50)')
     password = StringField(column_type='varchar(50)')
     email = StringField(column_type='varchar(50)')
@@ -14,7 +14,7 @@ class User(Model):
 class Blog(Model):
     __table__ = 'blogs'
 
-    id = StringField(primary_key=True, default=dao.generate_uid(), column_type='varchar(50)')
+    id = StringField(primary_key=True, default=dao.generate_uid, column_type='varchar(50)')
     user_id = StringField(column_type='varchar(50)')
     user_name = StringField(column_type='varchar(50)')
     user_image = StringField(column_type='varchar(500)')
@@ -26,7 +26,7 @@ class Blog(Model):
 class Comment(Model):
     __table__ = 'comments'
 
-    id = StringField(primary_key=True, default=dao.generate_uid(), column_type='varchar(50)')
+    id = StringField(primary_key=True, default=dao.generate_uid, column_type='varchar(50)')
     blog_id = StringField(column_type='varchar(50)')
     user_id = StringField(column_type='varchar(50)')
     user_name = StringField(column_type='varchar(50)')
@@ -48,12 +48,34 @@ class Food(Model):
 
 class Record(Model):
     __table__ = 'record'
+    # /api/records按用户以(record_time, record_id)分页，有了这个索引每一页只需要从游标处开始读size+1行
+    __indexes__ = [('user_id', 'record_time', 'record_id')]
 
-    record_id = StringField(primary_key=True, column_type='varchar(50)', default=dao.generate_uid())
+    record_id = StringField(primary_key=True, column_type='varchar(50)', default=dao.generate_uid)
     food_id = IntegerField(column_type='int')
     user_id = StringField(column_type='varchar(50)')
     amount = FloatField(column_type='float')
-    record_time = FloatField(column_type='float')
+    # findPage按record_time分页，游标中保存读出的值再用=比较，MySQL的float是单精度，读出的值与存储的不相等，
+    # 所以必须是double，已有的表需要执行 alter table record modify record_time double
+    record_time = FloatField(column_type='double')
+
+# 每个用户每天的营养摄入汇总，在写入Record的时候同步累加（见summary.py），
+# 这样按天查询汇总时只需要读这张表，不用把所有Record和Food连接起来求和
+class DailySummary(Model):
+    __table__ = 'daily_summary'
+
+    # 由user_id和day组成，比如'0015...000-2026-10-18'
+    summary_id = StringField(primary_key=True, column_type='varchar(64)')
+    user_id = StringField(column_type='varchar(50)')
+    day = StringField(column_type='varchar(10)')
+    energy = FloatField(column_type='float', default=0.0)
+    carbohydrate = FloatField(column_type='float', default=0.0)
+    protein = FloatField(column_type='float', default=0.0)
+    fat = FloatField(column_type='float', default=0.0)
+    records = IntegerField(column_type='int', default=0)
+
+# 应用使用的所有表，用于create_tables
+MODELS = [User, Food, Record, DailySummary]
 
 
 def test():
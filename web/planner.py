@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 根据营养目标（能量、蛋白质、脂肪、碳水）从food表中推荐食物组合和用量
+# 把所有食物的营养值放在一个numpy矩阵中，所有候选食物的计算都是矩阵运算，不对食物做python循环
+
+import numpy as np
+import dao
+from model import Food
+
+NUTRIENTS = ('energy', 'protein', 'fat', 'carbohydrate')
+
+class MealPlanner(object):
+    def __init__(self):
+        self._version = None
+        self.foods = []
+        # 每一行是一种食物每1单位amount（与Record.amount相同的单位）的营养值，列的顺序同NUTRIENTS
+        self.matrix = np.zeros((0, len(NUTRIENTS)))
+
+    def load(self, foods):
+        self.foods = list(foods)
+        m = np.array([[f[n] or 0.0 for n in NUTRIENTS] for f in self.foods], dtype=np.float64).reshape(-1, len(NUTRIENTS))
+        units = np.array([f.unit or 1.0 for f in self.foods], dtype=np.float64)
+        self.matrix = m / units[:, None]
+
+    # foods_cache是apis中的CatalogCache，food表有写入时重新生成矩阵
+    async def refresh(self, foods_cache):
+        version = dao.table_version(Food.__table__)
+        if version != self._version:
+            self.load(await foods_cache.all())
+            self._version = version
+
+    # targets是nutrient到目标值的dict，没有给出的营养素不参与计算
+    # 从count个不同的食物出发，每一步为所有出发点同时选出使（按目标值归一化的）误差下降最多的食物，
+    # 最多选size种食物。返回按误差从小到大排序的[(误差, [(食物下标, 用量), ...]), ...]
+    def plan(self, targets, size=3, count=5):
+        n = len(self.foods)
+        if n == 0:
+            return []
+        t = np.array([targets.get(k) or 0.0 for k in NUTRIENTS], dtype=np.float64)
+        w = np.where(t > 0, 1.0 / np.where(t > 0, t, 1.0), 0.0)
+        A = self.matrix * w                      # (n, 4) 归一化后的营养值
+        goal = t * w                             # 目标归一化后是1（或0）
+        norms = np.einsum('ij,ij->i', A, A)      # 每种食物的|a|^2
+        usable = norms > 0
+        safe_norms = np.where(usable, norms, 1.0)
+
+        # 第一步：每种食物单独匹配目标时的最优用量和误差，取误差最小的count种作为出发点
+        x = np.clip(A @ goal / safe_norms, 0.0, None)
+        err = np.einsum('ij,ij->i', goal - x[:, None] * A, goal - x[:, None] * A)
+        err[~usable] = np.inf
+        count = min(count, int(usable.sum()))
+        if count == 0:
+            return []
+        starts = np.argsort(err)[:count]
+
+        chosen = np.full((count, size), -1, dtype=np.int64)
+        amounts = np.zeros((count, size))
+        chosen[:, 0] = starts
+        amounts[:, 0] = x[starts]
+        residual = goal - amounts[:, :1] * A[starts]          # (count, 4)
+        rows = np.arange(count)
+        for step in range(1, size):
+            # 所有出发点 × 所有食物的一维最优用量以及误差下降量，一次矩阵乘法算完
+            dots = residual @ A.T                              # (count, n)
+            xs = np.clip(dots / safe_norms, 0.0, None)
+            gain = 2 * xs * dots - xs * xs * norms
+            gain[:, ~usable] = -np.inf
+            picked = chosen[:, :step]                          # 已经选过的食物不再选
+            r, c = np.nonzero(picked >= 0)
+            gain[r, picked[r, c]] = -np.inf
+            best = np.argmax(gain, axis=1)
+            ok = gain[rows, best] > 1e-12
+            chosen[ok, step] = best[ok]
+            amounts[ok, step] = xs[ok, best[ok]]
+            residual[ok] -= amounts[ok, step][:, None] * A[best[ok]]
+
+        errors = np.einsum('ij,ij->i', residual, residual)
+        plans = []
+        for i in np.argsort(errors):
+            items = [(int(f), float(a)) for f, a in zip(chosen[i], amounts[i]) if f >= 0 and a > 0]
+            plans.append((float(errors[i]), items))
+        return plans
+
+    # 一个组合的实际营养总量
+    def totals(self, items):
+        s = np.zeros(len(NUTRIENTS))
+        for f, a in items:
+            s += self.matrix[f] * a
+        return dict(zip(NUTRIENTS, s.tolist()))
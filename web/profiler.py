@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 生产环境中按需profile：configs.profile.enabled为True时，app.init才会安装这个模块的middleware、URL函数和事件循环延迟的检测，
+# 关闭时这些都不存在，没有任何开销
+# 随机抽取configs.profile.sample比例的请求，或者请求头X-Profile等于configs.profile.token的请求，用cProfile记录这次请求，
+# 按路由保存为pstats文件（默认在web/.profiles/<路由>/下），可以从/api/profiles查看报告或者下载之后用python3 -m pstats分析
+# cProfile记录的是整个线程，请求await的时候事件循环执行的其他请求也会被记录进去，所以同一时间只profile一个请求
+# 另外统计每个请求等待dao（连接池和SQL）的时间和事件循环的延迟，从/metrics输出
+
+import os, io, re, hmac, time, random, asyncio, logging, cProfile, pstats
+from aiohttp import web
+from webframe import get, APIPermissionError, APIValueError, APIResourceError
+from configs import configs
+import metrics
+
+SORT_KEYS = ('cumulative', 'tottime', 'calls', 'ncalls', 'time')
+ROUTE_RE = re.compile(r'^[A-Za-z0-9_]+$')
+FILE_RE = re.compile(r'^[A-Za-z0-9_.-]+\.prof$')
+
+# 正在profile的请求，cProfile同一时间只能有一个
+_active = None
+
+def profile_dir():
+    return configs.profile.dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.profiles')
+
+# ('GET', '/api/foods/{id}') -> 'GET_api_foods_id'，作为保存pstats文件的子目录名
+def route_name(labels):
+    return re.sub(r'[^A-Za-z0-9]+', '_', ' '.join(labels)).strip('_')
+
+# compare_digest对含有非ASCII字符的str抛出TypeError，所以比较编码之后的bytes
+# aiohttp用surrogateescape解码请求头，不是合法UTF-8的字节也要能编码回去
+def _token_matches(value):
+    token = configs.profile.token
+    return bool(token and value and hmac.compare_digest(value.encode('utf-8', 'surrogateescape'),
+                                                        token.encode('utf-8', 'surrogateescape')))
+
+# 文件名中带有时间、进程号、请求总耗时和等待dao的时间，按文件名排序就是按时间排序
+def _save(profiler, labels, elapsed, dao_seconds):
+    path = os.path.join(profile_dir(), route_name(labels))
+    os.makedirs(path, exist_ok=True)
+    now = time.time()
+    name = '%s.%03d-%d-%dms-dao%dms.prof' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), now % 1 * 1000,
+                                             os.getpid(), elapsed * 1000, dao_seconds * 1000)
+    profiler.dump_stats(os.path.join(path, name))
+    # 只保留最近的keep个
+    files = sorted(f for f in os.listdir(path) if FILE_RE.match(f))
+    for f in files[:-configs.profile.keep]:
+        try:
+            os.remove(os.path.join(path, f))
+        except OSError:
+            pass
+    logging.info('profiled %s %s (%.3fs, dao %.3fs): %s' % (labels[0], labels[1], elapsed, dao_seconds, name))
+    return name
+
+# 只处理URL函数（RequestHandler）的请求，静态文件和404不统计
+async def profile_factory(app, handler):
+    async def profile(request):
+        global _active
+        labels = getattr(getattr(request.match_info.handler, '__self__', None), '_labels', None)
+        if labels is None:
+            return await handler(request)
+        requested = _token_matches(request.headers.get(configs.profile.header))
+        profiler = None
+        if _active is None and (requested or random.random() < configs.profile.sample):
+            profiler = _active = cProfile.Profile()
+        total = [0.0]
+        token = metrics.dao_seconds.set(total)
+        start = time.perf_counter()
+        r = None
+        try:
+            if profiler is not None:
+                profiler.enable()
+            r = await handler(request)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                _active = None
+            metrics.dao_seconds.reset(token)
+            metrics.request_dao_seconds.observe(labels, total[0])
+            # 抛出异常（包括HTTPFound等）的请求也保存
+            if profiler is not None:
+                name = _save(profiler, labels, time.perf_counter() - start, total[0])
+        # 带有请求头的请求在响应头中返回保存的文件名，正在profile其他请求时返回busy
+        if requested and not r.prepared:
+            r.headers[configs.profile.header] = name if profiler is not None else 'busy'
+        return r
+    return profile
+
+# 每隔interval秒醒来一次，实际多睡的时间就是事件循环被阻塞的时间
+async def watch_loop_lag(loop, interval, slow):
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        metrics.loop_lag_seconds.observe((), lag)
+        if lag >= slow:
+            logging.warning('event loop blocked for %.3fs' % lag)
+
+def start_lag_watcher(loop):
+    return asyncio.ensure_future(watch_loop_lag(loop, configs.profile.lag_interval, configs.profile.slow_lag), loop=loop)
+
+# 查看profile的URL函数需要请求头X-Profile等于configs.profile.token
+# 不接受URL参数，否则token会被写进access log
+def check_token(request):
+    if not _token_matches(request.headers.get(configs.profile.header)):
+        raise APIPermissionError()
+
+def _route_path(route):
+    if not ROUTE_RE.match(route):
+        raise APIValueError('route', 'Invalid route.')
+    path = os.path.join(profile_dir(), route)
+    if not os.path.isdir(path):
+        raise APIResourceError('route', 'No profiles for this route.')
+    return path
+
+# 每个路由保存的pstats文件
+@get('/api/profiles')
+async def getProfiles(request):
+    check_token(request)
+    root = profile_dir()
+    routes = []
+    if os.path.isdir(root):
+        for route in sorted(os.listdir(root)):
+            path = os.path.join(root, route)
+            if ROUTE_RE.match(route) and os.path.isdir(path):
+                files = sorted((f for f in os.listdir(path) if FILE_RE.match(f)), reverse=True)
+                if files:
+                    routes.append(dict(route=route, count=len(files), files=files))
+    return dict(routes=routes)
+
+# 一个路由的所有pstats文件（或者file指定的一个）合并之后的文本报告，按sort排序，只显示前limit个函数
+@get('/api/profiles/{route}')
+async def getProfileReport(request, *, route, file=None, sort='cumulative', limit='40'):
+    check_token(request)
+    path = _route_path(route)
+    if file is not None:
+        if not FILE_RE.match(file) or not os.path.isfile(os.path.join(path, file)):
+            raise APIResourceError('file', 'No such profile.')
+        files = [file]
+    else:
+        files = sorted(f for f in os.listdir(path) if FILE_RE.match(f))
+        if not files:
+            raise APIResourceError('route', 'No profiles for this route.')
+    if sort not in SORT_KEYS:
+        raise APIValueError('sort', 'sort must be one of %s.' % ', '.join(SORT_KEYS))
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise APIValueError('limit', 'limit must be an integer.')
+    out = io.StringIO()
+    stats = pstats.Stats(*[os.path.join(path, f) for f in files], stream=out)
+    out.write('%d profiles of %s\n' % (len(files), route))
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return web.Response(text=out.getvalue(), content_type='text/plain')
+
+# 下载pstats文件，可以用python3 -m pstats或者snakeviz等工具查看
+@get('/api/profiles/{route}/{file}')
+async def downloadProfile(request, *, route, file):
+    check_token(request)
+    path = _route_path(route)
+    if not FILE_RE.match(file) or not os.path.isfile(os.path.join(path, file)):
+        raise APIResourceError('file', 'No such profile.')
+    with open(os.path.join(path, file), 'rb') as f:
+        body = f.read()
+    return web.Response(body=body, content_type='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename="%s"' % file})
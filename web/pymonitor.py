@@ -1,47 +1,109 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, sys, time, subprocess
+import os, sys, time, socket, select, signal, threading, subprocess
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from configs import configs
+
 command = ['echo', 'ok']
 process = None
+# 监听的socket由pymonitor创建并传给app.py，重启时新旧进程共用，所以重启期间不会拒绝连接
+listen_socket = None
+# 同一时间只进行一次重启
+restart_lock = threading.Lock()
+# 编辑器保存一次文件往往会产生好几个事件，最后一个事件之后等这么久才重启
+DEBOUNCE = 0.5
+# 新进程启动完成的最长等待时间，以及旧进程优雅退出的最长等待时间
+READY_TIMEOUT = 30.0
+STOP_TIMEOUT = 10.0
 
 def log(s):
     print('[Monitor] %s' % s)
 
 # 把restart这个方法绑定到消息响应中，watchdog的FileSystemEventHandler会对目录下任何修改作出反应
+# 连续的事件会被合并，只在最后一个事件之后DEBOUNCE秒重启一次
 class MyFileSystemEventHander(FileSystemEventHandler):
     def __init__(self, fn):
         super(MyFileSystemEventHander, self).__init__()
         self.restart = fn
+        self._timer = None
+        self._lock = threading.Lock()
 
     # 继承自FileSystemEventHandler
     def on_any_event(self, event):
         if event.src_path.endswith('.py'):
             log('Python source file changed: %s' % event.src_path)
-            self.restart()
+            with self._lock:
+                if self._timer:
+                    self._timer.cancel()
+                self._timer = threading.Timer(DEBOUNCE, self.restart)
+                self._timer.daemon = True
+                self._timer.start()
+
 
+def create_socket():
+    global listen_socket
+    host, port = configs.server.host, configs.server.port
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((host, port))
+    listen_socket.listen(128)
+    listen_socket.set_inheritable(True)
+    log('Listening on %s:%s...' % (host, port))
 
 def kill_process():
     global process
-    if process:
-        log('Kill process [%s]...' % process.pid)
-        process.kill()
-        process.wait()
-        log('Process ended with code %s.' % process.returncode)
-        process = None
+    p, process = process, None
+    stop_process(p)
 
+def stop_process(p):
+    if p and p.poll() is None:
+        log('Stop process [%s]...' % p.pid)
+        # 先发SIGTERM让app处理完正在进行的请求，超时再kill
+        p.send_signal(signal.SIGTERM)
+        try:
+            p.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+        log('Process ended with code %s.' % p.returncode)
+
+# 启动新的进程，等它写入ready（即数据库连接池、路由都已经准备好并开始处理请求）之后才返回True
 def start_process():
     global process, command
-    log('Start process %s...' % ' '.join(command))
-    process = subprocess.Popen(command, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
+    fd = listen_socket.fileno()
+    r, w = os.pipe()
+    args = command + ['--fd', str(fd), '--ready-fd', str(w)]
+    log('Start process %s...' % ' '.join(args))
+    p = subprocess.Popen(args, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr, pass_fds=(fd, w))
+    os.close(w)
+    ready = False
+    try:
+        if select.select([r], [], [], READY_TIMEOUT)[0]:
+            ready = os.read(r, 16).startswith(b'ready')
+    finally:
+        os.close(r)
+    if not ready:
+        log('Process [%s] failed to start.' % p.pid)
+        stop_process(p)
+        return None
+    log('Process [%s] is ready.' % p.pid)
+    return p
 
+# 先启动新的进程，确认可以正常工作之后再停止旧的进程；新进程启动失败时保留旧的进程
 def restart_process():
-    kill_process()
-    start_process()
+    global process
+    with restart_lock:
+        p = start_process()
+        if p is None:
+            if process:
+                log('Keep the running process [%s].' % process.pid)
+            return
+        old, process = process, p
+        stop_process(old)
 
 def start_watch(path, callback):
     observer = Observer()
@@ -49,13 +111,15 @@ def start_watch(path, callback):
     observer.schedule(MyFileSystemEventHander(restart_process), path, recursive=True)
     observer.start()
     log('Watching directory %s...' % path)
-    start_process()
+    create_socket()
+    restart_process()
     try:
         while True:
             time.sleep(0.5)
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    kill_process()
 
 if __name__ == '__main__':
     # print(sys.argv)
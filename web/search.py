@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 食物名称的内存索引，用于/api/foods/search
+# 名称先做NFKC和casefold的规范化，然后建立两种索引：
+#   1. 按名称排序的list，二分查找前缀
+#   2. n-gram倒排索引：所有字符的bigram，以及中日韩文字的单字（中文的单字查询很常见）
+# 查询时取各个gram倒排表的交集，再确认子串匹配并排序，耗时只和命中的数量有关，和食物总数无关
+
+import asyncio, bisect, logging, unicodedata
+import dao
+
+def normalize(s):
+    return unicodedata.normalize('NFKC', s or '').casefold().strip()
+
+def is_cjk(ch):
+    return unicodedata.east_asian_width(ch) in ('W', 'F')
+
+def grams(s):
+    s = s.replace(' ', '')
+    result = set(s[i:i+2] for i in range(len(s) - 1))
+    result.update(ch for ch in s if is_cjk(ch))
+    return result
+
+class NameIndex(object):
+    def __init__(self, model, column):
+        self._model = model
+        self._column = column
+        self._version = None
+        self._lock = asyncio.Lock()
+        self._rows = dict()      # 主键 -> Model
+        self._names = dict()     # 主键 -> 规范化后的名称
+        self._sorted = []        # [(规范化后的名称, 主键)]
+        self._postings = dict()  # gram -> set(主键)
+        dao.on_change(model.__table__, self._on_change)
+
+    def _add(self, row):
+        pk = row[self._model.__primary_key__]
+        name = normalize(row[self._column])
+        self._rows[pk] = row
+        self._names[pk] = name
+        bisect.insort(self._sorted, (name, pk))
+        for g in grams(name):
+            self._postings.setdefault(g, set()).add(pk)
+
+    def _remove(self, pk):
+        name = self._names.pop(pk, None)
+        if name is None:
+            return
+        del self._rows[pk]
+        i = bisect.bisect_left(self._sorted, (name, pk))
+        if i < len(self._sorted) and self._sorted[i] == (name, pk):
+            del self._sorted[i]
+        for g in grams(name):
+            s = self._postings.get(g)
+            if s is not None:
+                s.discard(pk)
+                if not s:
+                    del self._postings[g]
+
+    # Model写入后增量更新，还没有建好索引（或者正在载入）时忽略，之后会根据版本号重建
+    # 只有这一次写入正好是索引之后的下一个版本时才能增量更新，中间有没有回调的修改（比如dao.invalidate）时
+    # 索引已经过期了，这时丢掉版本号，下一次refresh重建
+    def _on_change(self, action, row):
+        if self._version is None:
+            return
+        version = dao.table_version(self._model.__table__)
+        if self._version != version - 1:
+            self._version = None
+            return
+        pk = row[self._model.__primary_key__]
+        self._remove(pk)
+        if action != 'remove':
+            self._add(row)
+        self._version = version
+
+    # source是一个带有async all()方法的对象，比如CatalogCache
+    async def refresh(self, source):
+        table = self._model.__table__
+        if self._version == dao.table_version(table):
+            return
+        async with self._lock:
+            version = dao.table_version(table)
+            if self._version == version:
+                return
+            logging.info('rebuild name index of %s...' % table)
+            self._version = None
+            rows = await source.all()
+            self._rows, self._names, self._sorted, self._postings = dict(), dict(), [], dict()
+            for row in rows:
+                self._add(row)
+            self._version = version
+
+    def _candidates(self, q, limit):
+        gs = grams(q)
+        if not gs:
+            # 单个非中日韩字符，只做前缀匹配，并且限制候选的数量，避免扫描大半个索引
+            i = bisect.bisect_left(self._sorted, (q,))
+            end = min(len(self._sorted), i + limit * 20)
+            result = set()
+            while i < end and self._sorted[i][0].startswith(q):
+                result.add(self._sorted[i][1])
+                i += 1
+            return result
+        postings = sorted((self._postings.get(g, ()) for g in gs), key=len)
+        result = set(postings[0])
+        for p in postings[1:]:
+            if not result:
+                break
+            result &= p
+        return result
+
+    # 返回按相关度排序的Model：完全相同 > 名称前缀 > 词的前缀 > 包含，然后名称越短越靠前
+    def search(self, q, limit=10):
+        q = normalize(q)
+        if not q:
+            return []
+        ranked = []
+        for pk in self._candidates(q, limit):
+            name = self._names[pk]
+            pos = name.find(q)
+            if pos < 0:
+                continue
+            if name == q:
+                rank = 0
+            elif pos == 0:
+                rank = 1
+            elif not name[pos-1].isalnum():
+                rank = 2
+            else:
+                rank = 3
+            ranked.append((rank, pos, len(name), name, pk))
+        ranked.sort()
+        return [self._rows[r[-1]] for r in ranked[:limit]]
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# JSON序列化，直接输出utf-8的bytes
+# Model转换为只包含已赋值列的dict；APIError转换为与RequestHandler中相同的dict
+# 安装了orjson时使用orjson（C实现，快很多），否则使用标准库的json
+# orjson遇到Model时要为每一行回调_default，比编码本身慢几倍，所以最外层（以及最外层dict的值）中
+# Model的list先用一个列表推导全部转换好；只输出JSON的查询最好直接用Model.find(as_dicts=True)
+
+import json
+from webframe import APIError
+from dao import Model
+
+def _default(o):
+    if isinstance(o, Model):
+        return o.to_dict()
+    if isinstance(o, APIError):
+        return dict(error=o.error, data=o.data, message=o.message)
+    if hasattr(o, '__dict__'):
+        return o.__dict__
+    raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+def _prepare(o):
+    if isinstance(o, Model):
+        return o.to_dict()
+    if type(o) is list:
+        if o and isinstance(o[0], Model):
+            return [m.to_dict() if isinstance(m, Model) else m for m in o]
+    elif type(o) is dict:
+        for v in o.values():
+            if isinstance(v, Model) or (type(v) is list and v and isinstance(v[0], Model)):
+                return {k: _prepare(v) for k, v in o.items()}
+    return o
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(o):
+        return orjson.dumps(_prepare(o), default=_default, option=_OPTIONS)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_default)
+
+    def dumps(o):
+        return _encoder.encode(_prepare(o)).encode('utf-8')
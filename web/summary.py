@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 维护daily_summary表：每个用户每天摄入的能量、碳水、蛋白质、脂肪的累计值
+# 写入Record时调用add_records做增量累加，rebuild用于第一次上线或者数据不一致时全部重算
+# 命令行用法: python3 summary.py [user_id]
+
+import asyncio, sys, time, logging
+import dao
+from configs import configs
+from model import Food, Record, DailySummary
+
+NUTRIENTS = ('energy', 'carbohydrate', 'protein', 'fat')
+
+# 同一个summary_id已经存在时直接在原值上累加，由数据库保证并发写入时不会丢失
+def _upsert():
+    return dao.upsert_sql(DailySummary.__table__, 'summary_id',
+                          ('summary_id', 'user_id', 'day') + NUTRIENTS + ('records',),
+                          increments=NUTRIENTS + ('records',))
+
+def day_of(record_time):
+    return time.strftime('%Y-%m-%d', time.localtime(float(record_time)))
+
+def summary_id(user_id, day):
+    return '%s-%s' % (user_id, day)
+
+# Food中的营养值是每unit（比如100g）的含量，记录的amount与unit的单位相同
+def nutrition(food, amount):
+    factor = amount / food.unit if food.unit else amount
+    return [(food[n] or 0.0) * factor for n in NUTRIENTS]
+
+# 把records按(user_id, day)累加，foods是food_id到Food的dict，找不到对应Food的记录会被忽略
+def aggregate(records, foods, totals=None):
+    if totals is None:
+        totals = dict()
+    for r in records:
+        food = foods.get(r.food_id)
+        if food is None:
+            logging.warning('food %s of record %s not found' % (r.food_id, r.record_id))
+            continue
+        key = (r.user_id, day_of(r.record_time))
+        values = totals.get(key)
+        if values is None:
+            values = totals[key] = [0.0] * len(NUTRIENTS) + [0]
+        for i, v in enumerate(nutrition(food, r.amount)):
+            values[i] += v
+        values[-1] += 1
+    return totals
+
+def _upsert_args(totals):
+    return [[summary_id(user_id, day), user_id, day] + values for (user_id, day), values in totals.items()]
+
+# 与写入Record在同一个事务中调用，把新记录累加到汇总表中
+# daily_summary的版本号在commit之后才更新，这样/api/summary/daily不会把旧的汇总缓存在新的ETag下
+async def add_records(records, foods):
+    totals = aggregate(records, foods)
+    if totals:
+        await dao.execute_many(_upsert(), _upsert_args(totals))
+        dao.notify_change(DailySummary, 'save')
+
+# 重新计算汇总，user_id为None时重算所有用户
+# 在同一个事务中先删除旧的汇总再分页读取记录：删除之前已经提交的记录都在之后读到的快照中，
+# 删除之后并发写入的记录，它们的汇总要等这个事务提交之后才能累加上去（SQLite的事务一开始就取得写锁，
+# MySQL的delete锁住了汇总表中的行和间隙），所以重算的结果既不会漏掉也不会重复计算
+# 代价是重算期间写入记录的请求都要等待，应该在写入少的时候运行
+async def rebuild(user_id=None):
+    foods = {f.food_id: f for f in await Food.find()}
+    if user_id is None:
+        where, args = None, []
+    else:
+        where, args = 'user_id=?', [user_id]
+    totals = dict()
+    async with dao.transaction():
+        if user_id is None:
+            await dao.execute('delete from `%s`' % DailySummary.__table__, [])
+        else:
+            await dao.execute('delete from `%s` where `user_id`=?' % DailySummary.__table__, [user_id])
+        # 事务中不能流式读取，按主键分页，每次只有一页在内存中
+        after = None
+        while True:
+            records, after = await Record.findPage(where, args, after=after, size=1000)
+            aggregate(records, foods, totals)
+            if after is None:
+                break
+        rows = _upsert_args(totals)
+        for i in range(0, len(rows), 1000):
+            await dao.execute_many(_upsert(), rows[i:i + 1000])
+        dao.notify_change(DailySummary, 'save')
+    logging.info('rebuild %s daily summaries.' % len(rows))
+    return len(rows)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(dao.create_connection(loop, db='diet_pal', backend=configs.db.backend, path=configs.db.path))
+    loop.run_until_complete(dao.create_tables(DailySummary))
+    loop.run_until_complete(rebuild(sys.argv[1] if len(sys.argv) > 1 else None))
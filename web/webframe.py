@@ -4,9 +4,11 @@
 # 考虑到app.py中利用的是aiohttp，在绑定url和对应方法，以及返回response方面比较复杂
 # 这里对aiohttp进行封装，DIY一个web framework来
 
-import asyncio, os, inspect, logging, functools
-from urllib import parse
+import asyncio, os, inspect, logging, functools, time, mimetypes, hashlib
+from email.utils import formatdate
 from aiohttp import web
+from configs import configs
+import dao, metrics, compress
 
 # 这个装饰器的目的是给URL函数加入两个属性，一个是path，即对应的URL，另一个是method，即get/post等
 # 这里的*是为了留给其他参数的，比如request等等
@@ -29,12 +31,116 @@ get = functools.partial(request_method_decorator,method = 'GET')
 post = functools.partial(request_method_decorator,method = 'POST')
 
 
+# 条件GET：URL函数的结果只由URL（包括query string）、models对应的表的内容，以及per_user=True时的当前用户决定
+# 这样不需要调用URL函数、也不需要对结果做hash，用表的版本号（dao.table_version）就可以生成ETag
+# 进程重启后版本号从0开始，所以ETag中还包括进程的启动时间
+# 多进程模式下supervisor给同一批worker相同的epoch（见app.Supervisor），这样各个worker生成的ETag可以通用
+_EPOCH = os.environ.get('DIETPAL_EPOCH') or '%d-%f' % (os.getpid(), time.time())
+
+class Conditional(object):
+    def __init__(self, tables, cache_control, per_user):
+        self.tables = tables
+        self.cache_control = cache_control
+        self.per_user = per_user
+
+    def etag(self, request):
+        parts = [_EPOCH, request.path_qs]
+        if configs.etag.window:
+            parts.append(str(int(time.time() // configs.etag.window)))
+        if self.per_user:
+            user = request.__user__
+            parts.append(user.user_id if user else '')
+        parts.extend('%s:%d' % (t, dao.table_version(t)) for t in self.tables)
+        # 同一个ETag可能对应gzip、br等不同的编码，所以是弱ETag
+        return 'W/"%s"' % hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:24]
+
+    def last_modified(self):
+        return formatdate(max(dao.table_modified(t) for t in self.tables), usegmt=True)
+
+    @staticmethod
+    def matches(request, etag):
+        header = request.headers.get('If-None-Match')
+        if not header:
+            return False
+        if header.strip() == '*':
+            return True
+        # 比较时忽略W/前缀
+        tag = etag[2:]
+        for t in header.split(','):
+            t = t.strip()
+            if t.startswith('W/'):
+                t = t[2:]
+            if t == tag:
+                return True
+        return False
+
+# 用法：放在@get之下，比如
+# @get('/api/foods')
+# @conditional(Food, cache_control='public, max-age=60')
+def conditional(*models, cache_control='private, no-cache', per_user=False):
+    def decorator(func):
+        func.__conditional__ = Conditional(tuple(m.__table__ for m in models), cache_control, per_user)
+        return func
+    return decorator
+
+
+# 静态文件：客户端接受br/gzip并且存在比原文件新的预压缩文件（由compress.py生成）时，直接返回压缩后的文件
+# 文件名中没有版本号，所以max_age要在发布新版本时配合修改文件名使用，debug模式下不缓存
+class StaticHandler(object):
+    def __init__(self, root, max_age):
+        self._root = root
+        self._cache_control = 'public, max-age=%d' % max_age if max_age else 'no-cache'
+
+    async def __call__(self, request):
+        path = os.path.realpath(os.path.join(self._root, request.match_info['filename']))
+        if not path.startswith(self._root + os.sep) or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        content_type, encoding = mimetypes.guess_type(path)
+        headers = {'Content-Type': content_type or 'application/octet-stream',
+                   'Cache-Control': self._cache_control}
+        if path.endswith(compress.PRECOMPRESS):
+            headers['Vary'] = 'Accept-Encoding'
+            codings = compress.accepted(request.headers.get('Accept-Encoding', ''))
+            mtime = os.path.getmtime(path)
+            stale = False
+            # 服务器上不需要安装brotli也可以返回.br文件
+            for coding, suffix in compress.SUFFIXES.items():
+                if coding not in codings or not os.path.isfile(path + suffix):
+                    continue
+                if os.path.getmtime(path + suffix) >= mtime:
+                    headers['Content-Encoding'] = coding
+                    return web.FileResponse(path + suffix, headers=headers)
+                stale = True
+            # 新版本的aiohttp的FileResponse自己也会找.br/.gz文件，而且不检查是否比原文件旧，
+            # 所以有过期的压缩文件时直接返回原文件的内容（之后由compress_factory压缩）
+            if stale:
+                body = await asyncio.get_event_loop().run_in_executor(None, _read_file, path)
+                return web.Response(body=body, headers=headers)
+        return web.FileResponse(path, headers=headers)
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
 # 添加静态文件夹的路径，类似于SimpleHTTPServer
 def add_static(app):
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path, show_index=True)
+    handler = StaticHandler(os.path.realpath(path), 0 if configs.debug else configs.static.max_age)
+    app.router.add_route('GET', '/static/{filename:.+}', handler.__call__)
+    app.router.add_route('HEAD', '/static/{filename:.+}', handler.__call__)
     logging.info('add static %s => %s' % ('/static/', path))
 
+# 把普通函数包装成协程函数，返回值是awaitable时（比如@get包装过的async def函数返回的协程）再await
+# 代替Python 3.11中已经删除的asyncio.coroutine
+def as_coroutine(fn):
+    @functools.wraps(fn)
+    async def coro(*args, **kw):
+        r = fn(*args, **kw)
+        if inspect.isawaitable(r):
+            r = await r
+        return r
+    return coro
+
 # add_route函数，用来注册一个URL处理函数
 # 主要起验证函数是否有包含URL的响应方法与路径信息，以及将函数变为协程。
 # 最终还是要通过aiohttp中web模块的router完成
@@ -43,9 +149,11 @@ def add_route(app, fn):
     path = getattr(fn, '__route__', None)
     if path is None or method is None:
         raise ValueError('@get or @post not defined in %s.' % str(fn))
-    if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-        fn = asyncio.coroutine(fn)
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    if not asyncio.iscoroutinefunction(fn):
+        fn = as_coroutine(fn)
+    # 注册绑定的__call__方法而不是实例：新版本的aiohttp只把协程函数当作handler直接调用，
+    # 否则会再包一层并要求返回StreamResponse，而URL函数返回的dict等要由response_factory转换
+    app.router.add_route(method, path, RequestHandler(app, fn).__call__)
 
 # 直接导入文件，批量注册一个URL处理函数
 def add_routes(app, module_name):
@@ -74,11 +182,26 @@ class RequestHandler(object):
     def __init__(self, app, fn):
         self._app = app
         self._func = fn
+        self._labels = (fn.__method__, fn.__route__)
         self._has_request_args = self.has_request_args(fn)
         self._has_var_kw_args = self.has_var_kw_args(fn)
         self._has_named_kw_args = self.has_named_kw_args(fn)
         self._named_kw_args = self.get_named_kw_args(fn)
         self._required_kw_args = self.get_required_kw_args(fn)
+        # 根据函数签名事先决定每次请求要做的事情，__call__中不再重复判断
+        # 只有函数接收关键字参数时才需要解析query string或者body
+        self._wants_kw_args = bool(self._has_var_kw_args or self._has_named_kw_args)
+        # 路径中没有{name}这样的变量时，match_info一定是空的
+        self._has_match_info = '{' in fn.__route__
+        # debug模式下模板可能随时修改，不使用条件GET
+        self._conditional = None if configs.debug else getattr(fn, '__conditional__', None)
+        if self._has_var_kw_args:
+            self._pick = dict
+        else:
+            # 没有**kw时，只取出函数声明的命名关键字参数
+            named = self._named_kw_args
+            self._pick = lambda params: {name: params[name] for name in named if name in params}
+        self._call = self._compile()
 
     # 运用inspect模块，创建几个函数用以获取URL处理函数与request参数之间的关系
     def get_required_kw_args(self, fn):
@@ -125,11 +248,46 @@ class RequestHandler(object):
                     'request must be the last named parameter in function: %s%s' % (fn.__name__, str(sig)))
         return found
 
-    # RequestHandler是一个类，由于定义了__call__()方法，因此可以将其实例视为函数。
-    async def __call__(self, request):
-        kw = None
-        if self._has_var_kw_args or self._has_named_kw_args or self._required_kw_args:
-            if request.method == 'POST':
+    # 根据函数签名和路由的HTTP方法，在add_route时生成这个路由专用的调用函数：从request中取出参数、检查并调用URL函数
+    # 每个路由只执行自己需要的步骤，比如没有参数的函数直接调用，GET的路由不检查Content-Type和body，
+    # 路径中没有变量的路由不合并match_info，参数有错误时返回HTTPBadRequest
+    def _compile(self):
+        fn = self._func
+        pick = self._pick
+        has_request = self._has_request_args
+        has_match_info = self._has_match_info
+        required = self._required_kw_args
+
+        if not self._wants_kw_args:
+            if has_match_info:
+                async def call(request):
+                    kw = dict(request.match_info)
+                    if has_request:
+                        kw['request'] = request
+                    return await fn(**kw)
+            elif has_request:
+                async def call(request):
+                    return await fn(request=request)
+            else:
+                async def call(request):
+                    return await fn()
+            return call
+
+        # 合并match_info并检查必需的参数，两者都不需要时为None
+        check = None
+        if has_match_info or required:
+            def check(request, kw):
+                if has_match_info:
+                    for k, v in request.match_info.items():
+                        if k in kw:
+                            logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+                        kw[k] = v
+                for name in required:
+                    if name not in kw:
+                        return web.HTTPBadRequest(text='Missing argument: %s' % name)
+
+        if fn.__method__ == 'POST':
+            async def call(request):
                 if not request.content_type:
                     return web.HTTPBadRequest(text='Missing Content_Type.')
                 ct = request.content_type.lower()
@@ -137,47 +295,54 @@ class RequestHandler(object):
                     params = await request.json()
                     if not isinstance(params, dict):
                         return web.HTTPBadRequest(text='JSON body must be object.')
-                    kw = params
                 elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
                     params = await request.post()
-                    kw = dict(**params)
                 else:
                     return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            kw = dict(**request.match_info)
+                kw = pick(params)
+                if has_request:
+                    kw['request'] = request
+                if check is not None:
+                    error = check(request, kw)
+                    if error is not None:
+                        return error
+                return await fn(**kw)
         else:
-            if not self._has_var_kw_args and self._named_kw_args:
-                # remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named arg:
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        if self._has_request_args:
-            kw['request'] = request
-        # check required kw:
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest(text='Missing argument: %s' % name)
-        # logging.info('call with args: %s' % str(kw))
-        # 调用对应对URL函数_func()，即fn，返回response
+            async def call(request):
+                # request.query由aiohttp解析并缓存，重复的key取第一个值
+                query = request.query
+                kw = pick(query) if query else dict()
+                if has_request:
+                    kw['request'] = request
+                if check is not None:
+                    error = check(request, kw)
+                    if error is not None:
+                        return error
+                return await fn(**kw)
+        return call
+
+    # RequestHandler是一个类，由于定义了__call__()方法，因此可以将其实例视为函数。
+    # 每次调用的耗时按路由记录到metrics中
+    async def __call__(self, request):
+        start = time.perf_counter()
         try:
-            r = await self._func(**kw)
-            return r
+            if self._conditional is not None and request.method == 'GET':
+                c = self._conditional
+                etag = c.etag(request)
+                cache = (etag, c.last_modified(), c.cache_control)
+                # 数据没有变化，不调用URL函数，直接返回304
+                if c.matches(request, etag):
+                    return web.HTTPNotModified(headers={'ETag': etag, 'Cache-Control': c.cache_control})
+                r = await self._call(request)
+                # 由response_factory加到响应头中，出错的结果不缓存
+                request.__cache__ = cache
+                return r
+            # 调用对应对URL函数_func()，即fn，返回response
+            return await self._call(request)
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
+        finally:
+            metrics.request_seconds.observe(self._labels, time.perf_counter() - start)
 
 
 # middleware